@@ -0,0 +1,195 @@
+"""
+admission.py — admission control in front of model inference.
+
+Without it every session that uploads goes straight into
+EcoScannerAI.process(), so under a burst all of them share the CPU/GPU
+at once and everyone's scan gets slow together. AdmissionController
+instead:
+
+  - runs at most `max_concurrent` inferences at a time,
+  - parks the rest in a bounded wait queue (at most `max_queue` scans,
+    and at most `max_per_user` from any one user),
+  - serves waiting users round-robin, so one user's batch of uploads
+    cannot starve everybody else,
+  - gives up on a waiter after `deadline_s` with a fast ServerBusy
+    ("position N in queue") instead of an open-ended spinner.
+
+Queue depth, wait times and rejections are kept as metrics for the
+diagnostics panel.
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+
+class ServerBusy(RuntimeError):
+    """Raised when a scan cannot be admitted in time; carries the queue position."""
+
+    def __init__(self, message, position=None):
+        super().__init__(message)
+        self.position = position
+
+
+class _Ticket:
+    __slots__ = ("user", "granted", "enqueued")
+
+    def __init__(self, user):
+        self.user = user
+        self.granted = False
+        self.enqueued = time.perf_counter()
+
+
+class AdmissionController:
+    """Bounded concurrency + bounded, per-user round-robin wait queue."""
+
+    WAIT_SAMPLES = 500
+
+    def __init__(self, max_concurrent: int = 2, max_queue: int = 32,
+                 max_per_user: int = 4, deadline_s: float = 15.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.deadline_s = deadline_s
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        # user -> deque of waiting tickets; dict order is the round-robin turn
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._waits_ms = deque(maxlen=self.WAIT_SAMPLES)
+        self.counters = {"admitted": 0, "rejected_full": 0,
+                         "rejected_deadline": 0, "peak_queue": 0}
+
+    @contextmanager
+    def slot(self, user: str, on_wait=None):
+        """
+        Hold one inference slot for the duration of the block. Raises
+        ServerBusy if the queue is full or the deadline passes first.
+        `on_wait(position)` is called whenever the queue position changes.
+        """
+        self._acquire(user, on_wait)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._grant_next()
+
+    def _acquire(self, user, on_wait):
+        with self._cond:
+            if self._in_flight < self.max_concurrent and not self._queued:
+                self._in_flight += 1
+                self._record_admit(0.0)
+                return
+
+            queue = self._queues.get(user)
+            if self._queued >= self.max_queue or (
+                    queue and len(queue) >= self.max_per_user):
+                self.counters["rejected_full"] += 1
+                raise ServerBusy(
+                    f"Server busy: {self._queued} scans already waiting.")
+
+            ticket = _Ticket(user)
+            self._queues.setdefault(user, deque()).append(ticket)
+            self._queued += 1
+            self.counters["peak_queue"] = max(self.counters["peak_queue"],
+                                              self._queued)
+
+            try:
+                self._wait(ticket, on_wait)
+            except BaseException:
+                # Deadline, or the script was stopped/rerun while queued:
+                # never leave a ticket (or a granted slot) behind
+                if ticket.granted:
+                    self._in_flight -= 1
+                    self._grant_next()
+                else:
+                    self._remove(ticket)
+                raise
+            self._record_admit((time.perf_counter() - ticket.enqueued) * 1000)
+
+    def _wait(self, ticket, on_wait):
+        deadline = ticket.enqueued + self.deadline_s
+        last_position = None
+        while not ticket.granted:
+            position = self._position(ticket)
+            if on_wait is not None and position != last_position:
+                last_position = position
+                # Don't hold the lock while the UI callback runs
+                self._cond.release()
+                try:
+                    on_wait(position)
+                finally:
+                    self._cond.acquire()
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.counters["rejected_deadline"] += 1
+                raise ServerBusy(
+                    f"Server busy: position {position} in queue.", position)
+            self._cond.wait(min(remaining, 0.5))
+
+    # ------------------------------------------------------------------
+    # INTERNALS (caller holds self._cond)
+    # ------------------------------------------------------------------
+    def _grant_next(self):
+        while self._in_flight < self.max_concurrent and self._queued:
+            user, queue = next(iter(self._queues.items()))
+            ticket = queue.popleft()
+            self._queued -= 1
+            # That user's turn is over: move them to the back of the line
+            del self._queues[user]
+            if queue:
+                self._queues[user] = queue
+            ticket.granted = True
+            self._in_flight += 1
+        self._cond.notify_all()
+
+    def _remove(self, ticket):
+        queue = self._queues[ticket.user]
+        queue.remove(ticket)
+        self._queued -= 1
+        if not queue:
+            del self._queues[ticket.user]
+        self._cond.notify_all()
+
+    def _position(self, ticket) -> int:
+        """1-based place in the round-robin serving order."""
+        queues = list(self._queues.values())
+        mine = self._queues[ticket.user]
+        depth = mine.index(ticket)
+        turn = queues.index(mine)
+        ahead = sum(min(len(q), depth) for q in queues)
+        ahead += sum(1 for q in queues[:turn] if len(q) > depth)
+        return ahead + 1
+
+    def _record_admit(self, wait_ms):
+        self.counters["admitted"] += 1
+        self._waits_ms.append(wait_ms)
+
+    # ------------------------------------------------------------------
+    # METRICS
+    # ------------------------------------------------------------------
+    def stats(self) -> dict:
+        """Current load, wait-time percentiles (ms) and counters."""
+        with self._cond:
+            waits = sorted(self._waits_ms)
+            return {
+                "in_flight": self._in_flight,
+                "max_concurrent": self.max_concurrent,
+                "queued": self._queued,
+                "waiting_users": len(self._queues),
+                "wait_p50_ms": _percentile(waits, 0.5),
+                "wait_p90_ms": _percentile(waits, 0.9),
+                "wait_max_ms": _percentile(waits, 1.0),
+                **self.counters,
+            }
+
+
+def _percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return round(sorted_values[i], 1)
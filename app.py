@@ -1,11 +1,24 @@
 import streamlit as st
 import pandas as pd
+import functools
 import os
 import platform
 import time
 import random
-from database import init_db, create_user, verify_user, add_history, get_history, get_all_user_stats
-from logic import EcoImpact, EcoScannerAI
+import threading
+import uuid
+from collections import deque
+from datetime import timedelta
+from database import (init_db, create_user, verify_user, add_history,
+                      get_all_user_stats, get_committed_detections, count_history,
+                      claim_maintenance, compact_history, get_user_summary,
+                      get_material_totals, get_daily_series, get_recent_history,
+                      get_shard_layout)
+from logic import EcoImpact, EcoScannerAI, ImageGate, ImageRejected
+from scans import ScanIndex
+from export import FORMATS, export_to_tempfile
+from artifacts import ArtifactStore, encode_thumbnail
+from admission import AdmissionController, ServerBusy
  
 # ==========================================
 # 1. PAGE CONFIGURATION
@@ -20,16 +33,126 @@ st.set_page_config(
 # ==========================================
 # 2. INITIALIZATION & CACHING
 # ==========================================
-init_db()
+_run_started = time.perf_counter()
+
+COMPACT_INTERVAL_S = 24 * 3600
+# First pass waits until the server has settled (plus jitter, so restarted
+# workers don't all check at once); after that, check hourly
+COMPACT_FIRST_DELAY_S = 600
+COMPACT_CHECK_S = 3600
+ 
+def _compaction_loop():
+    # Keeps history size bounded on hosts without cron (e.g. Streamlit Cloud).
+    # Every server process runs this loop; the claim stored in the database
+    # lets only one of them compact per interval.
+    time.sleep(COMPACT_FIRST_DELAY_S * random.uniform(1, 1.5))
+    while True:
+        try:
+            if claim_maintenance("compact_history", COMPACT_INTERVAL_S):
+                stats = compact_history()
+                if stats["totals_mismatch"]:
+                    print(f"Compaction Error: daily totals out of step "
+                          f"for {stats['totals_mismatch']}")
+        except Exception as e:
+            print(f"Compaction Error: {e}")
+        time.sleep(COMPACT_CHECK_S)
  
+@st.cache_resource
+def init_storage():
+    # Schema creation / migrations: once per server process, not per rerun
+    init_db()
+    threading.Thread(target=_compaction_loop, daemon=True).start()
+    return True
+
+init_storage()
+
+# Scale per-item weight by bounding-box size instead of the flat 25 g
+ESTIMATE_WEIGHT = os.environ.get("ECOSCANNER_ESTIMATE_WEIGHT") == "1"
+ 
+# Set to model_server.py's socket to share one model across app processes
+MODEL_SERVER = os.environ.get("ECOSCANNER_MODEL_SERVER")
+# Two-stage inference: nano model first, full model only when uncertain
+CASCADE = os.environ.get("ECOSCANNER_CASCADE") == "1"
+# Stage-1 confidences in [low, high) escalate to the full model
+CASCADE_BAND = EcoScannerAI.parse_band(
+    os.environ.get("ECOSCANNER_CASCADE_BAND", "%s,%s" % EcoScannerAI.UNCERTAINTY_BAND)
+)
+# Reject blank, blurry, badly exposed or huge uploads before inference
+GATE = os.environ.get("ECOSCANNER_GATE", "1") != "0"
+GATE_OPTIONS = {
+    "min_sharpness": float(os.environ.get("ECOSCANNER_MIN_SHARPNESS", 60.0)),
+    "min_entropy": float(os.environ.get("ECOSCANNER_MIN_ENTROPY", 2.5)),
+    "max_pixels": int(float(os.environ.get("ECOSCANNER_MAX_MEGAPIXELS", 60)) * 1e6),
+}
+ 
+@st.cache_resource
+def load_gate():
+    # Separate from the engine: cheap, and its stats can be shown
+    # without loading the model
+    return ImageGate(**GATE_OPTIONS) if GATE else None
+
+@st.cache_resource
+def loaded_engines():
+    """Engines load_ai_engine() has built so far in this process."""
+    return []
+
 @st.cache_resource
 def load_ai_engine():
-    return EcoScannerAI(), EcoImpact()
+    scanner = EcoScannerAI(server_address=MODEL_SERVER, cascade=CASCADE,
+                           uncertainty_band=CASCADE_BAND, gate=load_gate())
+    loaded_engines().append(scanner)
+    return scanner, EcoImpact()
+
+@st.cache_resource
+def load_scan_index():
+    return ScanIndex()
+
+# Scan artifacts (detections + JPEG thumbnail) are held in one shared,
+# byte-budgeted store instead of session state; see artifacts.py
+MB = 1024 * 1024
+ARTIFACT_BUDGETS = {
+    "session_bytes": int(float(os.environ.get("ECOSCANNER_ARTIFACT_SESSION_MB", 8)) * MB),
+    "memory_bytes": int(float(os.environ.get("ECOSCANNER_ARTIFACT_MEMORY_MB", 256)) * MB),
+    "disk_bytes": int(float(os.environ.get("ECOSCANNER_ARTIFACT_DISK_MB", 1024)) * MB),
+}
+
+# Inference admission: concurrent scans, wait-queue size, max wait (s)
+ADMISSION_OPTIONS = {
+    "max_concurrent": int(os.environ.get("ECOSCANNER_MAX_INFERENCE", 2)),
+    "max_queue": int(os.environ.get("ECOSCANNER_MAX_QUEUE", 32)),
+    "deadline_s": float(os.environ.get("ECOSCANNER_QUEUE_DEADLINE_S", 15)),
+}
+
+@st.cache_resource
+def load_admission():
+    return AdmissionController(**ADMISSION_OPTIONS)
+
+@st.cache_resource
+def load_artifact_store():
+    return ArtifactStore(**ARTIFACT_BUDGETS)
+
+def artifact_session():
+    """Stable id for this browser session's artifacts."""
+    if "artifact_session" not in st.session_state:
+        st.session_state.artifact_session = uuid.uuid4().hex
+    return st.session_state.artifact_session
+
+def _rewound(fileobj):
+    fileobj.seek(0)
+    return fileobj
+
+def drop_export():
+    """Close this session's prepared export file, if any."""
+    prepared = st.session_state.pop("export_file", None)
+    if prepared:
+        prepared[0].close()
  
 # ==========================================
 # 3. THEME ENGINE
 # ==========================================
-def apply_styles(is_dark):
+@st.cache_data
+def build_css(is_dark):
+    """Generate the theme stylesheet once per theme, not on every rerun."""
     if is_dark:
         bg              = "linear-gradient(135deg, #0f172a 0%, #1e293b 100%)"
         card_bg         = "rgba(255, 255, 255, 0.03)"
@@ -91,7 +214,7 @@ def apply_styles(is_dark):
         error_bg        = "#fee2e2"
         error_text      = "#991b1b"
  
-    st.markdown(f"""
+    return f"""
     <style>
  
     /* ── Base ──────────────────────────────────────────── */
@@ -352,7 +475,10 @@ def apply_styles(is_dark):
     }}
  
     </style>
-    """, unsafe_allow_html=True)
+    """
+
+def apply_styles(is_dark):
+    st.markdown(build_css(is_dark), unsafe_allow_html=True)
  
 # ==========================================
 # 4. SIDEBAR: AUTHENTICATION & SETTINGS
@@ -373,8 +499,10 @@ with st.sidebar:
         st.markdown(f"### Researcher: **{st.session_state.user}**")
         st.caption("Active Session: Research Terminal")
  
-        user_history = get_history(st.session_state.user)
-        total_items = len(user_history) if user_history else 0
+        # Counted once per login and bumped by commits, not refetched per rerun
+        if "history_count" not in st.session_state:
+            st.session_state.history_count = count_history(st.session_state.user)
+        total_items = st.session_state.history_count
         st.progress(
             min(total_items / 100, 1.0),
             text=f"Research Goal: {total_items}/100 items"
@@ -383,6 +511,9 @@ with st.sidebar:
         if st.button("Secure Logout"):
             st.session_state.logged_in = False
             st.session_state.user = None
+            st.session_state.pop("history_count", None)
+            drop_export()
+            load_artifact_store().drop_session(artifact_session())
             st.rerun()
     else:
         tab_login, tab_signup = st.tabs(["🔐 Login", "📝 Sign Up"])
@@ -398,6 +529,7 @@ with st.sidebar:
                 elif verify_user(u.strip(), p):
                     st.session_state.logged_in = True
                     st.session_state.user = u.strip()
+                    st.session_state.pop("history_count", None)
                     st.rerun()
                 else:
                     st.error("Invalid credentials. If new, please Sign Up first.")
@@ -422,7 +554,380 @@ with st.sidebar:
                     st.error("Username already exists. Choose another.")
  
 # ==========================================
-# 5. MAIN DASHBOARD
+# 5. DASHBOARD FRAGMENTS
+# Each panel reruns on its own when its widgets change, instead of
+# re-executing the whole script (CSS, sidebar, every other tab).
+# ==========================================
+def timed(name):
+    """Record how long each run of a fragment takes, for diagnostics."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record_rerun_time(name, started)
+        return inner
+    return wrap
+
+def record_rerun_time(name, started):
+    timings = st.session_state.setdefault("rerun_ms", {})
+    timings.setdefault(name, deque(maxlen=50)).append(
+        (time.perf_counter() - started) * 1000
+    )
+
+def run_scan(source, on_wait=None):
+    """
+    Run (or reuse) the scan for an upload. Returns (scan, image): the
+    compact scan record and the annotated JPEG thumbnail. Both are kept in
+    the artifact store per uploaded file so reruns never repeat inference;
+    if they were evicted, the scan index rebuilds them without the model.
+
+    Inference itself goes through the admission controller: raises
+    ServerBusy (not cached, so a rerun retries) if no slot frees up in
+    time; `on_wait(position)` reports progress through the queue. Model
+    errors propagate the same way and nothing is stored for them.
+    """
+    store = load_artifact_store()
+    session = artifact_session()
+    stored = store.get(session, source.file_id)
+    if stored:
+        return stored
+
+    scanner, impact_calc = load_ai_engine()
+    scan_index = load_scan_index()
+    start_time = time.time()
+    try:
+        # Pixel limit from the header alone: hashing decodes the whole image
+        if scanner.gate is not None:
+            scanner.gate.check(source, size_only=True)
+        match, digest, phash = scan_index.lookup(source.getvalue())
+        if not match:
+            # Gate first: a retake never waits for (or holds) a slot
+            if scanner.gate is not None:
+                scanner.gate.check(source)
+            with load_admission().slot(st.session_state.user, on_wait):
+                results, annotated_img = scanner.process(source, checked=True)
+    except ImageRejected as e:
+        # Cached like a result, so reruns don't re-check or re-count it
+        scan = {"file_id": source.file_id, "rejected": str(e)}
+        store.put(session, source.file_id, scan)
+        return scan, None
+    if match:
+        # Seen before: reuse stored detections, skip YOLO
+        scan_id, results, distance, size = match
+        annotated_img = scanner.render(source, results, size)
+    else:
+        # Model or model-server failures raise out of process() before
+        # this point, so an empty result here really means nothing found
+        scan_id = scan_index.record(
+            st.session_state.user, digest, phash, results,
+            (annotated_img.shape[1], annotated_img.shape[0])
+        )
+    co2_vals, weights = impact_calc.calculate_many(
+        [r['material'] for r in results],
+        areas=[r['area'] for r in results] if ESTIMATE_WEIGHT else None
+    )
+    scan = {
+        "file_id": source.file_id,
+        "results": results,
+        "scan_id": scan_id,
+        "cached": match is not None,
+        "co2": [float(v) for v in co2_vals],
+        "weights": [float(w) for w in weights],
+        "inference_time": round((time.time() - start_time) * 1000, 2),
+    }
+    # Only the encoded thumbnail outlives this run, not the RGB array
+    image = encode_thumbnail(annotated_img)
+    store.put(session, source.file_id, scan, image)
+    return scan, image
+
+@st.fragment
+@timed("Commit button")
+def commit_button(scan, i, already_committed):
+    res = scan["results"][i]
+    btn_key = f"save_{i}_{res['label']}_{res['material']}"
+    if already_committed:
+        if st.session_state.get("commit_notice") == (scan["file_id"], i):
+            # Set just before the full rerun that follows a commit
+            del st.session_state.commit_notice
+            st.toast(f"✅ {res['label']} recorded.")
+            st.balloons()
+        st.caption("✔️ Already recorded from this image.")
+    elif st.button(f"Commit {res['label']} to Portfolio", key=btn_key):
+        _, impact_calc = load_ai_engine()
+        if add_history(
+            st.session_state.user,
+            res['material'],
+            scan["co2"][i],
+            weight_g=scan["weights"][i],
+            factor_version=impact_calc.FACTOR_VERSION,
+            scan_id=scan["scan_id"],
+            detection_idx=i
+        ):
+            st.session_state.history_count = (
+                st.session_state.get("history_count", 0) + 1
+            )
+            # Whole-app rerun: the sidebar goal bar and this item's
+            # "already recorded" caption live outside this fragment
+            st.session_state.commit_notice = (scan["file_id"], i)
+            st.rerun()
+        else:
+            st.warning("Duplicate upload: this item has already been recorded.")
+
+@st.fragment
+@timed("Scanner panel")
+def scanner_panel():
+    st.markdown('<div class="glass-card">', unsafe_allow_html=True)
+    st.subheader("📸 Material Acquisition")
+ 
+    source = st.file_uploader(
+        "Upload waste image for analysis",
+        type=['png', 'jpg', 'jpeg'],
+        help="Upload a clear image of waste material for AI classification."
+    )
+ 
+    if source:
+        with st.status("Initializing Neural Inference...",
+                       expanded=True) as status:
+            try:
+                scan, annotated_img = run_scan(
+                    source,
+                    on_wait=lambda pos: status.update(
+                        label=f"Queued for inference: position {pos}..."
+                    )
+                )
+                if scan.get("rejected"):
+                    status.update(label="Retake Needed", state="error")
+                    st.warning(
+                        f"📷 {scan['rejected']} Please retake the photo; "
+                        "it was not sent to the model."
+                    )
+                    st.markdown('</div>', unsafe_allow_html=True)
+                    return
+                results = scan["results"]
+                scan_id = scan["scan_id"]
+ 
+                if annotated_img is not None:
+                    caption = (
+                        f"Detection Map  |  "
+                        f"Inference: {scan['inference_time']} ms"
+                    )
+                    if scan["cached"]:
+                        caption = (
+                            f"Detection Map  |  Cached result of "
+                            f"scan #{scan_id} ({scan['inference_time']} ms)"
+                        )
+                    st.image(
+                        annotated_img,
+                        caption=caption,
+                        use_container_width=True
+                    )
+                if scan["cached"]:
+                    st.info(
+                        "♻️ This image matches an earlier upload. "
+                        "Stored detections were reused; items that "
+                        "were already committed cannot be logged again."
+                    )
+ 
+                if results:
+                    status.update(
+                        label=(
+                            f"Scanning Complete: "
+                            f"{len(results)} material(s) identified"
+                        ),
+                        state="complete",
+                        expanded=False
+                    )
+                    st.success(
+                        f"Detections Finalized: **{len(results)}** "
+                        f"object(s) localised."
+                    )
+ 
+                    committed = (
+                        get_committed_detections(scan_id)
+                        if scan_id is not None else set()
+                    )
+                    for i, res in enumerate(results):
+                        with st.expander(
+                            f"📦 Object {i+1}: {res['label']} "
+                            f"({int(res['confidence']*100)}% Conf.)",
+                            expanded=True
+                        ):
+                            c1, c2 = st.columns([2, 1])
+                            c1.metric(
+                                "CO₂ Mitigation Potential",
+                                f"{scan['co2'][i]} kg"
+                            )
+                            c2.info(
+                                f"Category: **{res['material'].upper()}**"
+                            )
+                            commit_button(scan, i, i in committed)
+                else:
+                    status.update(
+                        label="Scan Finished: No Recyclables Detected",
+                        state="error"
+                    )
+                    st.warning(
+                        "No recyclable material recognised above the "
+                        "confidence threshold. Try a clearer image."
+                    )
+ 
+            except ServerBusy as e:
+                status.update(label="Server Busy", state="error")
+                st.warning(f"⏳ {e} Please try again in a moment.")
+                st.button("🔁 Retry Scan", key="retry_scan")
+            except Exception as e:
+                status.update(label="Inference Error", state="error")
+                st.error(f"Processing failed: {str(e)}")
+ 
+    st.markdown('</div>', unsafe_allow_html=True)
+
+AUDIT_LOG_ROWS = 200
+
+@st.fragment
+@timed("Analytics tab")
+def analytics_panel(username):
+    head_l, head_r = st.columns([4, 1])
+    head_l.subheader("📊 Your Environmental Contribution")
+    head_r.button("🔄 Refresh", key="refresh_stats")
+    summary = get_user_summary(username)
+ 
+    if summary["items"]:
+        # All figures come pre-aggregated from SQL (history_daily), so this
+        # costs the same for 10 items or 10 million
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Total CO₂ Mitigated",
+                  f"{round(summary['total_co2'], 4)} kg")
+        m2.metric("Total Items Audited", summary["items"])
+        m3.metric("Most Frequent Waste", summary["top_material"].title())
+        m4.metric("Avg. Mitigation/Item",
+                  f"{round(summary['mean_co2'], 3)} kg")
+ 
+        st.divider()
+        c_left, c_right = st.columns(2)
+        with c_left:
+            st.write("**Mitigation Trend Over Time**")
+            trend = pd.DataFrame(
+                get_daily_series(username), columns=["Day", "CO2 Saved", "Items"]
+            )
+            trend['Day'] = pd.to_datetime(trend['Day'])
+            st.line_chart(trend.set_index('Day')['CO2 Saved'])
+        with c_right:
+            st.write("**Material Distribution**")
+            pie_data = pd.DataFrame(
+                get_material_totals(username),
+                columns=["Material", "CO2 Saved", "Items"]
+            ).set_index('Material')['CO2 Saved']
+            st.bar_chart(pie_data)
+ 
+        st.divider()
+        st.write(f"**Audit Log** (latest {AUDIT_LOG_ROWS} entries)")
+        df = pd.DataFrame(
+            get_recent_history(username, AUDIT_LOG_ROWS),
+            columns=["Material", "CO2 Saved", "Timestamp", "Items"]
+        )
+        df['Timestamp'] = pd.to_datetime(df['Timestamp'], format="mixed")
+        st.dataframe(df, use_container_width=True)
+    else:
+        st.info(
+            "No audit history yet. Use the AI Scanner tab to begin "
+            "logging your environmental impact."
+        )
+
+@st.fragment
+@timed("Export panel")
+def export_panel(username):
+    with st.expander("⬇️ Export History"):
+        e1, e2 = st.columns(2)
+        scope = e1.radio(
+            "Scope", ["My history", "Global dataset"],
+            key="export_scope", horizontal=True
+        )
+        fmt = e2.radio(
+            "Format", list(FORMATS), key="export_fmt", horizontal=True
+        )
+        f1, f2 = st.columns(2)
+        dates = f1.date_input("Date range (optional)", value=(), key="export_dates")
+        materials = f2.multiselect(
+            "Materials (optional)",
+            sorted(set(EcoImpact().factors)),
+            key="export_materials"
+        )
+ 
+        if st.button("Prepare Export", key="export_prepare"):
+            filters = {"materials": materials or None}
+            if scope == "My history":
+                filters["username"] = username
+            if len(dates) == 2:
+                filters["start"] = dates[0].isoformat()
+                filters["end"] = (dates[1] + timedelta(days=1)).isoformat()
+            drop_export()
+            try:
+                # Written to a temp file in chunks, never held as a DataFrame
+                st.session_state.export_file = (
+                    export_to_tempfile(fmt, **filters), fmt
+                )
+            except RuntimeError as e:
+                st.error(str(e))
+ 
+        prepared = st.session_state.get("export_file")
+        if prepared:
+            tmp, prepared_fmt = prepared
+            mime, ext = FORMATS[prepared_fmt]
+            st.download_button(
+                f"Download .{ext}",
+                # Deferred: the file is only read when the button is clicked,
+                # not on every rerun that redraws it
+                data=functools.partial(_rewound, tmp),
+                file_name=f"ecoscanner_history.{ext}",
+                mime=mime,
+                key="export_download"
+            )
+
+@st.cache_data(ttl=30)
+def load_leaderboard():
+    # Shared by every session; a few seconds of staleness is fine here
+    return get_all_user_stats()
+
+@st.fragment
+@timed("Leaderboard tab")
+def leaderboard_panel():
+    head_l, head_r = st.columns([4, 1])
+    head_l.subheader("🏆 Global Sustainability Rankings")
+    if head_r.button("🔄 Refresh", key="refresh_ranks"):
+        load_leaderboard.clear()
+    all_stats = load_leaderboard()
+ 
+    if all_stats:
+        leader_df = pd.DataFrame(
+            all_stats, columns=["Researcher", "Total CO2 Saved"]
+        )
+        leader_df = leader_df.sort_values(
+            by="Total CO2 Saved", ascending=False
+        ).reset_index(drop=True)
+        leader_df.index += 1
+ 
+        top_n = min(3, len(leader_df))
+        top_3 = leader_df.head(top_n)
+        st.markdown("### 🥇 Top Contributors")
+        medals = ["🥇 Gold", "🥈 Silver", "🥉 Bronze"]
+        t_cols = st.columns(top_n)
+        for idx, col in enumerate(t_cols):
+            col.metric(
+                medals[idx],
+                top_3.iloc[idx]['Researcher'],
+                f"{round(top_3.iloc[idx]['Total CO2 Saved'], 3)} kg CO₂"
+            )
+ 
+        st.divider()
+        st.table(leader_df)
+    else:
+        st.warning("No leaderboard data yet. Be the first to log a scan!")
+ 
+# ==========================================
+# 6. MAIN DASHBOARD
 # ==========================================
 if st.session_state.logged_in:
     st.title("🌎 Sustainability Dashboard")
@@ -442,94 +947,7 @@ if st.session_state.logged_in:
         col_main, col_side = st.columns([2, 1])
  
         with col_main:
-            st.markdown('<div class="glass-card">', unsafe_allow_html=True)
-            st.subheader("📸 Material Acquisition")
- 
-            source = st.file_uploader(
-                "Upload waste image for analysis",
-                type=['png', 'jpg', 'jpeg'],
-                help="Upload a clear image of waste material for AI classification."
-            )
- 
-            if source:
-                scanner, impact_calc = load_ai_engine()
- 
-                with st.status("Initializing Neural Inference...",
-                               expanded=True) as status:
-                    start_time = time.time()
-                    try:
-                        results, annotated_img = scanner.process(source)
-                        inference_time = round(
-                            (time.time() - start_time) * 1000, 2
-                        )
- 
-                        if annotated_img is not None:
-                            st.image(
-                                annotated_img,
-                                caption=(
-                                    f"Detection Map  |  "
-                                    f"Inference: {inference_time} ms"
-                                ),
-                                use_container_width=True
-                            )
- 
-                        if results:
-                            status.update(
-                                label=(
-                                    f"Scanning Complete: "
-                                    f"{len(results)} material(s) identified"
-                                ),
-                                state="complete",
-                                expanded=False
-                            )
-                            st.success(
-                                f"Detections Finalized: **{len(results)}** "
-                                f"object(s) localised."
-                            )
- 
-                            for i, res in enumerate(results):
-                                co2_val = impact_calc.calculate(res['material'])
-                                with st.expander(
-                                    f"📦 Object {i+1}: {res['label']} "
-                                    f"({int(res['confidence']*100)}% Conf.)",
-                                    expanded=True
-                                ):
-                                    c1, c2 = st.columns([2, 1])
-                                    c1.metric(
-                                        "CO₂ Mitigation Potential",
-                                        f"{co2_val} kg"
-                                    )
-                                    c2.info(
-                                        f"Category: **{res['material'].upper()}**"
-                                    )
- 
-                                    btn_key = f"save_{i}_{res['label']}_{res['material']}"
-                                    if st.button(
-                                        f"Commit {res['label']} to Portfolio",
-                                        key=btn_key
-                                    ):
-                                        add_history(
-                                            st.session_state.user,
-                                            res['material'],
-                                            co2_val
-                                        )
-                                        st.toast(f"✅ {res['label']} recorded.")
-                                        st.balloons()
-                        else:
-                            status.update(
-                                label="Scan Finished: No Recyclables Detected",
-                                state="error"
-                            )
-                            st.warning(
-                                "No recyclable material recognised above the "
-                                "confidence threshold. Try a clearer image."
-                            )
- 
-                    except Exception as e:
-                        status.update(label="Inference Error", state="error")
-                        st.error(f"Processing failed: {str(e)}")
- 
-            st.markdown('</div>', unsafe_allow_html=True)
+            scanner_panel()
  
         with col_side:
             st.markdown('<div class="glass-card">', unsafe_allow_html=True)
@@ -562,78 +980,12 @@ if st.session_state.logged_in:
  
     # ---- TAB 2: ANALYTICS ----------------------------------------
     with tab_stats:
-        st.subheader("📊 Your Environmental Contribution")
-        history = get_history(st.session_state.user)
- 
-        if history:
-            df = pd.DataFrame(
-                history, columns=["Material", "CO2 Saved", "Timestamp"]
-            )
-            df['Timestamp'] = pd.to_datetime(df['Timestamp'])
- 
-            m1, m2, m3, m4 = st.columns(4)
-            m1.metric("Total CO₂ Mitigated",
-                      f"{round(df['CO2 Saved'].sum(), 4)} kg")
-            m2.metric("Total Items Audited", len(df))
-            m3.metric(
-                "Most Frequent Waste",
-                df['Material'].mode()[0].title() if not df.empty else "N/A"
-            )
-            m4.metric("Avg. Mitigation/Item",
-                      f"{round(df['CO2 Saved'].mean(), 3)} kg")
- 
-            st.divider()
-            c_left, c_right = st.columns(2)
-            with c_left:
-                st.write("**Mitigation Trend Over Time**")
-                st.line_chart(df.set_index('Timestamp')['CO2 Saved'])
-            with c_right:
-                st.write("**Material Distribution**")
-                pie_data = df.groupby('Material')['CO2 Saved'].sum()
-                st.bar_chart(pie_data)
- 
-            st.divider()
-            st.write("**Full Audit Log**")
-            st.dataframe(
-                df.sort_values(by='Timestamp', ascending=False),
-                use_container_width=True
-            )
-        else:
-            st.info(
-                "No audit history yet. Use the AI Scanner tab to begin "
-                "logging your environmental impact."
-            )
+        analytics_panel(st.session_state.user)
+        export_panel(st.session_state.user)
  
     # ---- TAB 3: LEADERBOARD ----------------------------------------
     with tab_ranks:
-        st.subheader("🏆 Global Sustainability Rankings")
-        all_stats = get_all_user_stats()
- 
-        if all_stats:
-            leader_df = pd.DataFrame(
-                all_stats, columns=["Researcher", "Total CO2 Saved"]
-            )
-            leader_df = leader_df.sort_values(
-                by="Total CO2 Saved", ascending=False
-            ).reset_index(drop=True)
-            leader_df.index += 1
- 
-            top_n = min(3, len(leader_df))
-            top_3 = leader_df.head(top_n)
-            st.markdown("### 🥇 Top Contributors")
-            medals = ["🥇 Gold", "🥈 Silver", "🥉 Bronze"]
-            t_cols = st.columns(top_n)
-            for idx, col in enumerate(t_cols):
-                col.metric(
-                    medals[idx],
-                    top_3.iloc[idx]['Researcher'],
-                    f"{round(top_3.iloc[idx]['Total CO2 Saved'], 3)} kg CO₂"
-                )
- 
-            st.divider()
-            st.table(leader_df)
-        else:
-            st.warning("No leaderboard data yet. Be the first to log a scan!")
+        leaderboard_panel()
  
     # ---- TAB 4: KNOWLEDGE HUB ----------------------------------------
     with tab_edu:
@@ -668,7 +1020,7 @@ if st.session_state.logged_in:
             )
  
 # ==========================================
-# 6. LANDING PAGE FOR VISITORS
+# 7. LANDING PAGE FOR VISITORS
 # ==========================================
 else:
     col_l, col_r = st.columns([1.2, 1])
@@ -704,8 +1056,11 @@ else:
         )
  
 # ==========================================
-# 7. SYSTEM DIAGNOSTICS
+# 8. SYSTEM DIAGNOSTICS
 # ==========================================
+# Everything above is what a full-page rerun costs
+record_rerun_time("Full page", _run_started)
+ 
 with st.expander("🛠️ System Infrastructure & Research Diagnostics"):
     st.markdown("### Environment Specifications")
     diag_c1, diag_c2 = st.columns(2)
@@ -721,7 +1076,87 @@ with st.expander("🛠️ System Infrastructure & Research Diagnostics"):
         )
         st.write(f"**Neural Weights:** {weights_found}")
         st.write(f"**Database Engine:** SQLite 3 (Persistent)")
+        layout = get_shard_layout()
+        if layout["shards"] or layout["target"] is not None:
+            st.write(
+                f"**History Shards:** {layout['shards']} files"
+                + (f" (resharding to {layout['target']})"
+                   if layout["target"] is not None else "")
+            )
         st.write(f"**Inference Library:** Ultralytics YOLOv8 v8.4.5")
+        if MODEL_SERVER:
+            scanner, _ = load_ai_engine()
+            health = scanner.client.health()
+            if health.get("ok"):
+                st.write(
+                    f"**Model Server:** pid {health['pid']} — "
+                    f"{health['served']} scans served, "
+                    f"{health['free_slots']}/{health['slots']} ring slots free"
+                )
+            else:
+                st.write(f"**Model Server:** ⚠️ unavailable ({health.get('error')})")
+            cascade_stats = health.get("cascade")
+            band = health.get("band", EcoScannerAI.UNCERTAINTY_BAND)
+        else:
+            # Only if a scan already loaded the model; never load it here
+            engines = loaded_engines()
+            cascade_stats = engines[-1].cascade_stats if CASCADE and engines else None
+            band = CASCADE_BAND
+        if cascade_stats and cascade_stats["scans"]:
+            st.write(
+                f"**Cascade Escalation:** "
+                f"{cascade_stats['escalated']}/{cascade_stats['scans']} scans "
+                f"({cascade_stats['escalated'] / cascade_stats['scans']:.0%}) "
+                f"needed the full model (uncertainty band "
+                f"{band[0]:g}–{band[1]:g})"
+            )
+        artifacts = load_artifact_store().stats(artifact_session())
+        st.write(
+            f"**Scan Artifacts:** {artifacts['memory_bytes'] / 1e6:.1f} MB in "
+            f"memory ({artifacts['memory_items']} scans, this session "
+            f"{artifacts['session_bytes'] / 1e6:.1f} MB), "
+            f"{artifacts['disk_bytes'] / 1e6:.1f} MB spilled to disk "
+            f"({artifacts['disk_items']} scans), {artifacts['evicted']} evicted"
+        )
+        admission = load_admission().stats()
+        st.write(
+            f"**Inference Admission:** {admission['in_flight']}/"
+            f"{admission['max_concurrent']} running, {admission['queued']} "
+            f"queued (peak {admission['peak_queue']}); wait p50 "
+            f"{admission['wait_p50_ms']} ms, p90 {admission['wait_p90_ms']} ms; "
+            f"rejected {admission['rejected_full']} queue-full, "
+            f"{admission['rejected_deadline']} deadline"
+        )
+        gate = load_gate()
+        if gate is not None and gate.stats["checked"]:
+            skipped = {r: n for r, n in gate.stats.items()
+                       if r != "checked" and n}
+            st.write(
+                f"**Pre-inference Gate:** {sum(skipped.values())}/"
+                f"{gate.stats['checked']} uploads rejected without inference"
+                + (" (" + ", ".join(f"{r.replace('_', ' ')}: {n}"
+                                    for r, n in skipped.items()) + ")"
+                   if skipped else "")
+            )
+ 
+    st.markdown("### Rerun Timing")
+    st.caption(
+        "Full page = every interaction before fragments; the panels below "
+        "now rerun on their own when their widgets change."
+    )
+    timings = st.session_state.get("rerun_ms", {})
+    st.table(pd.DataFrame(
+        [
+            {
+                "Scope": name,
+                "Runs": len(samples),
+                "Last (ms)": round(samples[-1], 1),
+                "Median (ms)": round(sorted(samples)[len(samples) // 2], 1),
+            }
+            for name, samples in timings.items()
+        ],
+        columns=["Scope", "Runs", "Last (ms)", "Median (ms)"]
+    ))
  
     if st.button("Run System Integrity Trace"):
         with st.status("Verifying components..."):
@@ -0,0 +1,198 @@
+"""
+artifacts.py — bounded storage for per-session scan artifacts.
+
+A scan used to live in st.session_state as the full-resolution annotated
+RGB array plus its results, for as long as the session did, so memory
+grew with users x image size. Instead, every scan is kept here as:
+
+  - a compact record (detections, CO2 figures, scan id; plain JSON), and
+  - the annotated image as a JPEG thumbnail (a few hundred KB at most).
+
+One ArtifactStore is shared by all sessions of a server process. It
+accounts bytes per session and in total. When a session goes over its
+budget, its least recently used scans are spilled to a disk cache. When
+the process goes over its budget, the least recently used scans of any
+session are spilled. The disk cache has its own budget and drops its
+oldest files outright; a dropped scan is simply rebuilt on the next
+rerun that needs it (from the duplicate-upload index, without the model).
+"""
+
+import atexit
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import PIL.Image
+
+THUMB_SIDE = 1280
+THUMB_QUALITY = 85
+
+DEFAULT_SESSION_BYTES = 8 * 1024 * 1024
+DEFAULT_MEMORY_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_BYTES = 1024 * 1024 * 1024
+
+
+def encode_thumbnail(img_array, max_side: int = THUMB_SIDE,
+                     quality: int = THUMB_QUALITY) -> bytes:
+    """JPEG-encode an RGB array, downscaled so the long side <= max_side."""
+    img = PIL.Image.fromarray(img_array)
+    img.thumbnail((max_side, max_side), PIL.Image.BILINEAR)
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=quality)
+    return buf.getvalue()
+
+
+class ArtifactStore:
+    """
+    Thread-safe LRU of (record, blob) pairs keyed by (session, key), with
+    per-session and global memory budgets and a bounded disk spill.
+    """
+
+    def __init__(self, session_bytes: int = DEFAULT_SESSION_BYTES,
+                 memory_bytes: int = DEFAULT_MEMORY_BYTES,
+                 disk_bytes: int = DEFAULT_DISK_BYTES, spill_dir: str = None):
+        self.session_bytes = session_bytes
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        # Private directory per process, removed on exit
+        self.spill_dir = tempfile.mkdtemp(prefix="ecoscanner-artifacts-",
+                                          dir=spill_dir)
+        atexit.register(shutil.rmtree, self.spill_dir, True)
+
+        self._memory = OrderedDict()   # (session, key) -> (record, blob, nbytes)
+        self._disk = OrderedDict()     # (session, key) -> (path, nbytes)
+        self._session_used = {}        # session -> bytes held in memory (> 0)
+        self._memory_used = 0
+        self._disk_used = 0
+        self._lock = threading.Lock()
+        self.counters = {"spilled": 0, "restored": 0, "evicted": 0}
+
+    # ------------------------------------------------------------------
+    # PUBLIC API
+    # ------------------------------------------------------------------
+    def put(self, session: str, key: str, record: dict, blob: bytes = None):
+        """Store a scan for `session`; may spill older scans to disk."""
+        entry = (session, key)
+        nbytes = len(json.dumps(record)) + len(blob or b"")
+        with self._lock:
+            self._discard(entry)
+            self._admit(entry, record, blob, nbytes)
+
+    def get(self, session: str, key: str):
+        """(record, blob) for a stored scan, or None if it was evicted."""
+        entry = (session, key)
+        with self._lock:
+            if entry in self._memory:
+                self._memory.move_to_end(entry)
+                record, blob, _ = self._memory[entry]
+                return record, blob
+            if entry not in self._disk:
+                return None
+            path, _ = self._disk[entry]
+            record, blob = self._read(path)
+            self._discard(entry)
+            self.counters["restored"] += 1
+            self._admit(entry, record, blob,
+                        len(json.dumps(record)) + len(blob or b""))
+            return record, blob
+
+    def drop_session(self, session: str):
+        """Forget every scan of a session (e.g. on logout)."""
+        with self._lock:
+            for entry in [e for e in self._memory if e[0] == session]:
+                self._discard(entry)
+            for entry in [e for e in self._disk if e[0] == session]:
+                self._discard(entry)
+
+    def stats(self, session: str = None) -> dict:
+        """Bytes and entry counts in memory and on disk, plus counters."""
+        with self._lock:
+            stats = {
+                "memory_bytes": self._memory_used,
+                "memory_items": len(self._memory),
+                "disk_bytes": self._disk_used,
+                "disk_items": len(self._disk),
+                "sessions": len(self._session_used),
+                **self.counters,
+            }
+            if session is not None:
+                stats["session_bytes"] = self._session_used.get(session, 0)
+            return stats
+
+    # ------------------------------------------------------------------
+    # INTERNALS (caller holds self._lock)
+    # ------------------------------------------------------------------
+    def _admit(self, entry, record, blob, nbytes):
+        session = entry[0]
+        self._memory[entry] = (record, blob, nbytes)
+        self._memory_used += nbytes
+        self._session_used[session] = self._session_used.get(session, 0) + nbytes
+
+        # The newest scan always stays in memory, even if alone over budget
+        while self._session_used[session] > self.session_bytes:
+            victim = next((e for e in self._memory
+                           if e[0] == session and e != entry), None)
+            if victim is None:
+                break
+            self._spill(victim)
+        while self._memory_used > self.memory_bytes:
+            victim = next((e for e in self._memory if e != entry), None)
+            if victim is None:
+                break
+            self._spill(victim)
+
+    def _release(self, entry, nbytes):
+        self._memory_used -= nbytes
+        self._session_used[entry[0]] -= nbytes
+        if self._session_used[entry[0]] <= 0:
+            del self._session_used[entry[0]]
+
+    def _spill(self, entry):
+        record, blob, nbytes = self._memory.pop(entry)
+        self._release(entry, nbytes)
+
+        name = hashlib.sha1(repr(entry).encode()).hexdigest() + ".bin"
+        path = os.path.join(self.spill_dir, name)
+        header = json.dumps(record).encode()
+        with open(path, "wb") as f:
+            f.write(len(header).to_bytes(4, "big"))
+            f.write(header)
+            f.write(blob or b"")
+        size = 4 + len(header) + len(blob or b"")
+        self._disk[entry] = (path, size)
+        self._disk_used += size
+        self.counters["spilled"] += 1
+
+        while self._disk_used > self.disk_bytes and self._disk:
+            _, (old_path, old_size) = self._disk.popitem(last=False)
+            self._disk_used -= old_size
+            self._unlink(old_path)
+            self.counters["evicted"] += 1
+
+    def _discard(self, entry):
+        if entry in self._memory:
+            _, _, nbytes = self._memory.pop(entry)
+            self._release(entry, nbytes)
+        if entry in self._disk:
+            path, size = self._disk.pop(entry)
+            self._disk_used -= size
+            self._unlink(path)
+
+    @staticmethod
+    def _read(path):
+        with open(path, "rb") as f:
+            data = f.read()
+        n = int.from_bytes(data[:4], "big")
+        return json.loads(data[4:4 + n]), data[4 + n:] or None
+
+    @staticmethod
+    def _unlink(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
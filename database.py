@@ -20,7 +20,10 @@ sidebar) but is reset on full server redeployment.
 
 import sqlite3
 import bcrypt
+import hashlib
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 # ------------------------------------------------------------------
 # DB PATH
@@ -29,17 +32,55 @@ import os
 # ------------------------------------------------------------------
 DB_PATH = os.path.join("/tmp", "ecoscanner.db")
 
+# ------------------------------------------------------------------
+# RETENTION
+# Raw history older than RETENTION_DAYS is rolled up into per-user,
+# per-material, per-day totals by compact_history(). If the file is
+# still above MAX_DB_BYTES afterwards the horizon is tightened.
+# ------------------------------------------------------------------
+RETENTION_DAYS = int(os.environ.get("ECOSCANNER_RETENTION_DAYS", "90"))
+MAX_DB_BYTES = int(float(os.environ.get("ECOSCANNER_DB_MAX_MB", "256")) * 1024 * 1024)
+
+# ------------------------------------------------------------------
+# HISTORY SHARDS
+# With N > 0 shards, history and its derived tables (history_rollup,
+# history_daily, scan_claims) live in N extra SQLite files next to
+# DB_PATH, chosen by a stable hash of the username, so commits from
+# different users stop queueing on one writer lock. Users and scans stay
+# in DB_PATH. Only used when a new database is created; change the shard
+# count of an existing one with `python manage.py reshard`.
+# ------------------------------------------------------------------
+HISTORY_SHARDS = int(os.environ.get("ECOSCANNER_HISTORY_SHARDS", "0"))
 
-def _get_conn():
-    """Return a connection to the SQLite database."""
-    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+_HISTORY_COLUMNS = ("username, material, co2_saved, timestamp, weight_g, "
+                    "factor_version, scan_id, detection_idx")
+
+
+def _get_conn(path: str = None):
+    """Return a connection to the SQLite database (or one history shard)."""
+    conn = sqlite3.connect(path or DB_PATH, check_same_thread=False)
     conn.row_factory = sqlite3.Row
     return conn
 
 
+def _create_history_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS history (
+            id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            username  TEXT    NOT NULL,
+            material  TEXT    NOT NULL,
+            co2_saved REAL    NOT NULL,
+            timestamp DATETIME DEFAULT (datetime('now'))
+        )
+    """)
+
+
 def init_db():
     """Create tables if they do not already exist."""
     with _get_conn() as conn:
+        # Only takes effect on a brand-new file (before the first table);
+        # compact_history() converts older files with a one-off VACUUM.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
         conn.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 id       INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -48,16 +89,356 @@ def init_db():
                 email    TEXT    NOT NULL
             )
         """)
+        _create_history_table(conn)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS scans (
+                id           INTEGER PRIMARY KEY AUTOINCREMENT,
+                username     TEXT    NOT NULL,
+                content_hash TEXT    UNIQUE NOT NULL,
+                phash        INTEGER NOT NULL,
+                width        INTEGER,
+                height       INTEGER,
+                detections   TEXT    NOT NULL,
+                created      DATETIME DEFAULT (datetime('now'))
+            )
+        """)
+        _migrate(conn)
+        # Shard layout: `shards` files in use (0 = history kept in this
+        # file); `target` is set while an online reshard is running, and
+        # shard_moved lists the users already moved to the target layout.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS shard_layout (
+                id      INTEGER PRIMARY KEY CHECK (id = 1),
+                shards  INTEGER NOT NULL,
+                target  INTEGER
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS shard_moved (
+                username TEXT PRIMARY KEY
+            )
+        """)
+        # Last start of each periodic job, shared by every app process
         conn.execute("""
-            CREATE TABLE IF NOT EXISTS history (
-                id        INTEGER PRIMARY KEY AUTOINCREMENT,
+            CREATE TABLE IF NOT EXISTS maintenance_runs (
+                task     TEXT PRIMARY KEY,
+                last_run DATETIME
+            )
+        """)
+        # A new database takes ECOSCANNER_HISTORY_SHARDS; existing history
+        # stays where it is until resharded
+        conn.execute(
+            "INSERT OR IGNORE INTO shard_layout (id, shards) VALUES (1, "
+            "CASE WHEN EXISTS (SELECT 1 FROM history_daily) THEN 0 ELSE ? END)",
+            (HISTORY_SHARDS,)
+        )
+        conn.commit()
+        shards = conn.execute("SELECT shards FROM shard_layout").fetchone()[0]
+
+    if "ECOSCANNER_HISTORY_SHARDS" in os.environ and shards != HISTORY_SHARDS:
+        print(f"History is stored in {shards} shard(s), not "
+              f"{HISTORY_SHARDS}; run `python manage.py reshard "
+              f"--shards {HISTORY_SHARDS}` to change it.")
+    for path in _history_paths():
+        if path != DB_PATH:
+            _init_history_file(path)
+
+
+def _init_history_file(path: str):
+    """Create (or migrate) the history tables in a shard file."""
+    with _get_conn(path) as conn:
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        _create_history_table(conn)
+        _migrate(conn)
+        conn.commit()
+
+
+def _columns(conn, table: str) -> set:
+    """Return the column names of `table`."""
+    return {r["name"] for r in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def _migrate(conn):
+    """
+    Bring an existing database up to the current schema.
+    Steps are keyed on PRAGMA user_version so each runs once per file.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    if version < 1:
+        # Weight and factor-table version per row, so CO2 can be
+        # re-derived when EcoImpact.factors changes. Legacy rows were
+        # all computed with the fixed 25 g weight and factor table v1.
+        cols = _columns(conn, "history")
+        if "weight_g" not in cols:
+            conn.execute(
+                "ALTER TABLE history ADD COLUMN weight_g REAL NOT NULL DEFAULT 25"
+            )
+        if "factor_version" not in cols:
+            conn.execute(
+                "ALTER TABLE history "
+                "ADD COLUMN factor_version INTEGER NOT NULL DEFAULT 1"
+            )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_history_factor_version "
+            "ON history (factor_version)"
+        )
+        conn.execute("PRAGMA user_version = 1")
+
+    if version < 2:
+        # Link each committed item back to the scan and detection it came
+        # from. The partial unique index lets a given detection be
+        # committed once, however many times its image is re-uploaded.
+        cols = _columns(conn, "history")
+        if "scan_id" not in cols:
+            conn.execute("ALTER TABLE history ADD COLUMN scan_id INTEGER")
+        if "detection_idx" not in cols:
+            conn.execute("ALTER TABLE history ADD COLUMN detection_idx INTEGER")
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_history_scan_detection "
+            "ON history (scan_id, detection_idx) WHERE scan_id IS NOT NULL"
+        )
+        conn.execute("PRAGMA user_version = 2")
+
+    if version < 3:
+        # Per-user lookups (sidebar count, history tab) without a scan
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_history_user_time "
+            "ON history (username, timestamp)"
+        )
+        conn.execute("PRAGMA user_version = 3")
+
+    if version < 4:
+        # Compacted history: exact totals of raw rows past the retention
+        # horizon. history_all presents raw and rolled-up rows uniformly.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history_rollup (
+                username       TEXT    NOT NULL,
+                material       TEXT    NOT NULL,
+                day            DATE    NOT NULL,
+                items          INTEGER NOT NULL,
+                co2_saved      REAL    NOT NULL,
+                weight_g       REAL    NOT NULL,
+                factor_version INTEGER NOT NULL,
+                PRIMARY KEY (username, material, day)
+            )
+        """)
+        conn.execute("""
+            CREATE VIEW IF NOT EXISTS history_all AS
+                SELECT username, material, co2_saved, timestamp, 1 AS items
+                FROM history
+                UNION ALL
+                SELECT username, material, co2_saved, day AS timestamp, items
+                FROM history_rollup
+        """)
+        conn.execute("PRAGMA user_version = 4")
+
+    if version < 5:
+        # Per-user daily totals for the Analytics tab, kept current by
+        # triggers so dashboards never scan raw history. Compaction moves
+        # rows from history to history_rollup without touching this table.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history_daily (
                 username  TEXT    NOT NULL,
+                day       DATE    NOT NULL,
                 material  TEXT    NOT NULL,
+                items     INTEGER NOT NULL,
                 co2_saved REAL    NOT NULL,
-                timestamp DATETIME DEFAULT (datetime('now'))
+                PRIMARY KEY (username, day, material)
             )
         """)
-        conn.commit()
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS history_daily_insert
+            AFTER INSERT ON history
+            BEGIN
+                INSERT INTO history_daily
+                    (username, day, material, items, co2_saved)
+                VALUES
+                    (NEW.username, date(NEW.timestamp), NEW.material,
+                     1, NEW.co2_saved)
+                ON CONFLICT (username, day, material) DO UPDATE SET
+                    items     = items + 1,
+                    co2_saved = co2_saved + excluded.co2_saved;
+            END
+        """)
+        # recompute_co2() rewrites co2_saved in history: apply the delta.
+        # (Roll-up rewrites are applied by recompute_co2() itself; a trigger
+        # there would also fire on compaction's upserts.)
+        conn.execute("""
+            CREATE TRIGGER IF NOT EXISTS history_daily_update
+            AFTER UPDATE OF co2_saved ON history
+            BEGIN
+                UPDATE history_daily
+                SET co2_saved = co2_saved + NEW.co2_saved - OLD.co2_saved
+                WHERE username = NEW.username AND day = date(NEW.timestamp)
+                  AND material = NEW.material;
+            END
+        """)
+        _rebuild_daily(conn)
+        conn.execute("PRAGMA user_version = 5")
+
+    if version < 6:
+        # "This detection was committed" claims, split out of history so
+        # they can live in the scan owner's shard while the history row
+        # goes to the committing user's shard
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS scan_claims (
+                scan_id       INTEGER NOT NULL,
+                detection_idx INTEGER NOT NULL,
+                PRIMARY KEY (scan_id, detection_idx)
+            )
+        """)
+        conn.execute(
+            "INSERT OR IGNORE INTO scan_claims (scan_id, detection_idx) "
+            "SELECT scan_id, detection_idx FROM history "
+            "WHERE scan_id IS NOT NULL"
+        )
+        conn.execute("PRAGMA user_version = 6")
+
+    if version < 7:
+        # v5 also put a delta trigger on history_rollup, which fired on the
+        # ON CONFLICT upserts of compaction and resharding too and counted
+        # merged CO2 into history_daily a second time. Drop it and rebuild
+        # the daily totals from the (always exact) rows they summarise.
+        conn.execute("DROP TRIGGER IF EXISTS history_rollup_daily_update")
+        _rebuild_daily(conn)
+        conn.execute("PRAGMA user_version = 7")
+
+
+def _rebuild_daily(conn):
+    """Recreate history_daily from raw and compacted history."""
+    conn.execute("DELETE FROM history_daily")
+    conn.execute("""
+        INSERT INTO history_daily (username, day, material, items, co2_saved)
+        SELECT username, date(timestamp), material, SUM(items), SUM(co2_saved)
+        FROM history_all
+        GROUP BY username, date(timestamp), material
+    """)
+
+
+# ------------------------------------------------------------------
+# SHARD ROUTING
+# Every function that touches history goes through _route(): one small
+# read of shard_layout per call, so all app processes follow a reshard
+# as soon as it commits a user's move.
+# ------------------------------------------------------------------
+def shard_index(username: str, shards: int) -> int:
+    """Stable shard number for a user (unlike hash(), same in every process)."""
+    digest = hashlib.blake2b(username.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+
+def _shard_path(index: int) -> str:
+    root, ext = os.path.splitext(DB_PATH)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def _layout_paths(shards: int) -> list:
+    """History files of a layout; 0 shards means DB_PATH itself."""
+    if not shards:
+        return [DB_PATH]
+    return [_shard_path(i) for i in range(shards)]
+
+
+def _file_for(username: str, shards: int) -> str:
+    if not shards:
+        return DB_PATH
+    return _shard_path(shard_index(username, shards))
+
+
+def get_shard_layout() -> dict:
+    """{"shards": N, "target": M or None (while resharding)}."""
+    conn = _get_conn()
+    try:
+        row = conn.execute("SELECT shards, target FROM shard_layout").fetchone()
+    except sqlite3.OperationalError:
+        row = None  # not initialised yet: history is in DB_PATH
+    finally:
+        conn.close()
+    return {"shards": row[0] if row else 0, "target": row[1] if row else None}
+
+
+def _history_paths() -> list:
+    """Every file that may hold history right now (both layouts mid-reshard)."""
+    layout = get_shard_layout()
+    paths = _layout_paths(layout["shards"])
+    if layout["target"] is not None:
+        paths += _layout_paths(layout["target"])
+    return list(dict.fromkeys(paths))
+
+
+def _route(username: str) -> str:
+    """The history file currently holding `username`'s rows."""
+    return _routes([username])[0]
+
+
+def _routes(usernames) -> list:
+    """_route() for several users over one connection."""
+    conn = _get_conn()
+    try:
+        row = conn.execute("SELECT shards, target FROM shard_layout").fetchone()
+        if row is None:
+            return [DB_PATH] * len(usernames)
+        shards, target = row
+        paths = []
+        for username in usernames:
+            moved = target is not None and conn.execute(
+                "SELECT 1 FROM shard_moved WHERE username = ?", (username,)
+            ).fetchone()
+            paths.append(_file_for(username, target if moved else shards))
+        return paths
+    except sqlite3.OperationalError:
+        return [DB_PATH] * len(usernames)  # not initialised yet
+    finally:
+        conn.close()
+
+
+def _routed_write(usernames, work):
+    """
+    Run work(conn) in one write transaction on the history file holding
+    every user in `usernames`. The route is re-checked once that file's
+    write lock is held: a reshard moves a user while holding the lock of
+    the file they are leaving, so a writer that queued behind the move
+    goes on to the new file instead of writing into the old one.
+    Returns (True, result), or (False, None) if the users are in
+    different files.
+    """
+    while True:
+        paths = set(_routes(usernames))
+        if len(paths) > 1:
+            return False, None
+        path = paths.pop()
+        conn = _get_conn(path)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if set(_routes(usernames)) != {path}:
+                conn.rollback()
+                continue
+            result = work(conn)
+            conn.commit()
+            return True, result
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+
+def _scatter(query, paths=None):
+    """Run query(conn) on every history file in parallel; list of results."""
+    paths = paths or _history_paths()
+
+    def run(path):
+        conn = _get_conn(path)
+        try:
+            return query(conn)
+        finally:
+            conn.close()
+
+    if len(paths) == 1:
+        return [run(paths[0])]
+    with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+        return list(pool.map(run, paths))
 
 
 def create_user(username: str, password: str, email: str) -> bool:
@@ -103,42 +484,762 @@ def verify_user(username: str, password: str) -> bool:
         return False
 
 
-def add_history(username: str, material: str, co2_saved: float):
-    """Log a recycling event for the given user."""
+def _scan_owner(scan_id: int):
     with _get_conn() as conn:
+        row = conn.execute(
+            "SELECT username FROM scans WHERE id = ?", (scan_id,)
+        ).fetchone()
+    return row["username"] if row else None
+
+
+def add_history(username: str, material: str, co2_saved: float,
+                weight_g: float = 25.0, factor_version: int = 1,
+                scan_id: int = None, detection_idx: int = None) -> bool:
+    """
+    Log a recycling event for the given user.
+    `weight_g` and `factor_version` record how co2_saved was derived.
+    Returns False if this (scan_id, detection_idx) was already committed.
+
+    The row goes to the user's history file. A detection's claim lives
+    with the scan's owner; if that is another file, the claim is taken
+    first and released again should the history insert fail.
+    """
+    values = (username, material, co2_saved, weight_g, factor_version,
+              scan_id, detection_idx)
+
+    def insert(conn):
         conn.execute(
-            "INSERT INTO history (username, material, co2_saved) "
-            "VALUES (?, ?, ?)",
-            (username, material, co2_saved)
+            "INSERT INTO history "
+            "(username, material, co2_saved, weight_g, factor_version, "
+            " scan_id, detection_idx) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            values
         )
-        conn.commit()
+
+    def claim(conn):
+        conn.execute(
+            "INSERT INTO scan_claims (scan_id, detection_idx) VALUES (?, ?)",
+            (scan_id, detection_idx)
+        )
+
+    def claim_and_insert(conn):
+        claim(conn)
+        insert(conn)
+
+    try:
+        if scan_id is None:
+            _routed_write([username], insert)
+            return True
+        owner = _scan_owner(scan_id) or username
+        done, _ = _routed_write([owner, username], claim_and_insert)
+        if not done:
+            _routed_write([owner], claim)
+            try:
+                _routed_write([username], insert)
+            except BaseException:
+                _routed_write([owner], lambda conn: conn.execute(
+                    "DELETE FROM scan_claims "
+                    "WHERE scan_id = ? AND detection_idx = ?",
+                    (scan_id, detection_idx)
+                ))
+                raise
+        return True
+    except sqlite3.IntegrityError:
+        # Duplicate commit of the same detection (scan_claims primary key)
+        return False
 
 
 def get_history(username: str):
     """
     Return all history rows for a user, ordered by most recent first.
-    Each row is (material, co2_saved, timestamp).
+    Each row is (material, co2_saved, timestamp, items): raw events have
+    items = 1, compacted days carry their item count and a date stamp.
     """
-    with _get_conn() as conn:
+    with _get_conn(_route(username)) as conn:
         rows = conn.execute(
-            "SELECT material, co2_saved, timestamp "
-            "FROM history WHERE username = ? "
+            "SELECT material, co2_saved, timestamp, items "
+            "FROM history_all WHERE username = ? "
             "ORDER BY timestamp DESC",
             (username,)
         ).fetchall()
     return [tuple(r) for r in rows]
 
 
+def count_history(username: str) -> int:
+    """Return the number of items a user has logged, compacted or not."""
+    with _get_conn(_route(username)) as conn:
+        row = conn.execute(
+            "SELECT COALESCE(SUM(items), 0) FROM history_daily "
+            "WHERE username = ?",
+            (username,)
+        ).fetchone()
+    return row[0]
+
+
 def get_all_user_stats():
     """
     Return aggregated (username, total_co2_saved) for the leaderboard,
-    ordered by highest total first.
+    ordered by highest total first. Sharded: every file is queried in
+    parallel and per-user totals are summed (a user's rows can briefly
+    span two files while a reshard is finishing).
+    """
+    parts = _scatter(lambda conn: conn.execute(
+        "SELECT username, SUM(co2_saved) AS total "
+        "FROM history_daily "
+        "GROUP BY username"
+    ).fetchall())
+    totals = {}
+    for rows in parts:
+        for r in rows:
+            totals[r["username"]] = totals.get(r["username"], 0.0) + r["total"]
+    return sorted(totals.items(), key=lambda kv: kv[1], reverse=True)
+
+
+# ------------------------------------------------------------------
+# ANALYTICS
+# Everything the Analytics tab shows, computed in SQL from the
+# history_daily roll-up: cost grows with days active, not with items.
+# ------------------------------------------------------------------
+def get_user_summary(username: str) -> dict:
+    """
+    Headline figures for a user: total_co2, items, mean_co2 (per item)
+    and top_material (most items; ties broken alphabetically).
+    """
+    with _get_conn(_route(username)) as conn:
+        total, items = conn.execute(
+            "SELECT COALESCE(SUM(co2_saved), 0), COALESCE(SUM(items), 0) "
+            "FROM history_daily WHERE username = ?",
+            (username,)
+        ).fetchone()
+        top = conn.execute(
+            "SELECT material FROM history_daily WHERE username = ? "
+            "GROUP BY material ORDER BY SUM(items) DESC, material LIMIT 1",
+            (username,)
+        ).fetchone()
+    return {
+        "total_co2": total,
+        "items": items,
+        "mean_co2": total / items if items else 0.0,
+        "top_material": top["material"] if top else None,
+    }
+
+
+def get_material_totals(username: str):
+    """Return [(material, co2_saved, items), ...] for a user."""
+    with _get_conn(_route(username)) as conn:
+        rows = conn.execute(
+            "SELECT material, SUM(co2_saved), SUM(items) "
+            "FROM history_daily WHERE username = ? "
+            "GROUP BY material ORDER BY material",
+            (username,)
+        ).fetchall()
+    return [tuple(r) for r in rows]
+
+
+def get_daily_series(username: str):
+    """Return [(day, co2_saved, items), ...] for a user, oldest first."""
+    with _get_conn(_route(username)) as conn:
+        rows = conn.execute(
+            "SELECT day, SUM(co2_saved), SUM(items) "
+            "FROM history_daily WHERE username = ? "
+            "GROUP BY day ORDER BY day",
+            (username,)
+        ).fetchall()
+    return [tuple(r) for r in rows]
+
+
+def get_recent_history(username: str, limit: int = 200):
+    """
+    The `limit` most recent history rows, newest first, in get_history()
+    shape. Reads raw rows through the (username, timestamp) index and
+    only tops up from compacted days if there are too few.
+    """
+    with _get_conn(_route(username)) as conn:
+        rows = conn.execute(
+            "SELECT material, co2_saved, timestamp, 1 AS items "
+            "FROM history WHERE username = ? "
+            "ORDER BY timestamp DESC LIMIT ?",
+            (username, limit)
+        ).fetchall()
+        if len(rows) < limit:
+            rows += conn.execute(
+                "SELECT material, co2_saved, day, items "
+                "FROM history_rollup WHERE username = ? "
+                "ORDER BY day DESC LIMIT ?",
+                (username, limit - len(rows))
+            ).fetchall()
+    return [tuple(r) for r in rows]
+
+
+HISTORY_EXPORT_COLUMNS = ("username", "material", "co2_saved", "timestamp", "items")
+
+
+def iter_history(username: str = None, start: str = None, end: str = None,
+                 materials=None, chunk_size: int = 1000):
+    """
+    Stream history rows (raw and compacted) as tuples in
+    HISTORY_EXPORT_COLUMNS order, `chunk_size` rows at a time, so memory
+    stays flat however large the table is. All filters are applied in
+    SQL: `start` is inclusive, `end` exclusive ('YYYY-MM-DD[ HH:MM:SS]').
+
+    Each chunk is its own short read (keyset paging), so a long export
+    never holds a read lock that would block commits. Pages follow rowid,
+    or for one user the (username, ...) index, so every page is an index
+    range scan and never re-sorts the user's remaining rows. Raw history
+    (file by file, when sharded) comes before compacted days. Not a
+    snapshot: rows committed or compacted while the export runs may or
+    may not be included.
+    """
+    materials = list(materials or ())
+    paths = [_route(username)] if username is not None else _history_paths()
+    # Raw rows, then compacted days (stamped with their date). Page keys
+    # for a single user match idx_history_user_time (rowid implied) and
+    # history_rollup's (username, material, day) primary key.
+    for table, stamp, items, user_key in (
+            ("history", "timestamp", "1", ("timestamp", "rowid")),
+            ("history_rollup", "day", "items", ("material", "day"))):
+        key = user_key if username is not None else ("rowid",)
+        clauses, args = [], []
+        if username is not None:
+            clauses.append("username = ?")
+            args.append(username)
+        if start:
+            clauses.append(f"{stamp} >= ?")
+            args.append(start)
+        if end:
+            clauses.append(f"{stamp} < ?")
+            args.append(end)
+        if materials:
+            clauses.append(f"material IN ({', '.join('?' * len(materials))})")
+            args.extend(materials)
+        after = (f"({', '.join(key)}) > ({', '.join('?' * len(key))})")
+        select = (f"SELECT {', '.join(key)}, username, material, co2_saved, "
+                  f"{stamp}, {items} FROM {table}")
+        order = f"ORDER BY {', '.join(key)} LIMIT ?"
+
+        for path in paths:
+            conn = _get_conn(path)
+            try:
+                last = None
+                while True:
+                    where = clauses + ([after] if last else [])
+                    sql = select
+                    if where:
+                        sql += f" WHERE {' AND '.join(where)}"
+                    rows = conn.execute(
+                        f"{sql} {order}", [*args, *(last or ()), chunk_size]
+                    ).fetchall()
+                    if not rows:
+                        break
+                    last = tuple(rows[-1])[:len(key)]
+                    for r in rows:
+                        yield tuple(r)[len(key):]
+            finally:
+                conn.close()
+
+
+def add_scan(username: str, content_hash: str, phash: int, detections: list,
+             width: int = None, height: int = None) -> int:
+    """
+    Store a scan's hashes and compact detection set.
+    Returns the scan id; an identical image returns the existing id.
+    """
+    with _get_conn() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO scans "
+            "(username, content_hash, phash, width, height, detections) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (username, content_hash, phash, width, height,
+             json.dumps(detections, separators=(",", ":")))
+        )
+        conn.commit()
+        row = conn.execute(
+            "SELECT id FROM scans WHERE content_hash = ?", (content_hash,)
+        ).fetchone()
+    return row["id"]
+
+
+def get_scan(scan_id: int = None, content_hash: str = None):
+    """
+    Fetch one scan by id or by content hash.
+    Returns (id, phash, detections, (width, height)) or None.
+    """
+    if scan_id is not None:
+        where, key = "id = ?", scan_id
+    else:
+        where, key = "content_hash = ?", content_hash
+    with _get_conn() as conn:
+        row = conn.execute(
+            f"SELECT id, phash, detections, width, height "
+            f"FROM scans WHERE {where}", (key,)
+        ).fetchone()
+    if row is None:
+        return None
+    return (row["id"], row["phash"], json.loads(row["detections"]),
+            (row["width"], row["height"]))
+
+
+def iter_scan_hashes(after_id: int = 0, chunk_size: int = 10_000):
+    """Yield (id, phash) for every scan with id > after_id, in id order."""
+    with _get_conn() as conn:
+        cur = conn.execute(
+            "SELECT id, phash FROM scans WHERE id > ? ORDER BY id",
+            (after_id,)
+        )
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for r in rows:
+                yield r["id"], r["phash"]
+
+
+def get_oldest_scan_id():
+    """Lowest scan id still stored (None if there are no scans)."""
+    with _get_conn() as conn:
+        row = conn.execute("SELECT MIN(id) FROM scans").fetchone()
+    return row[0]
+
+
+def get_committed_detections(scan_id: int) -> set:
+    """Return the detection indices of a scan already logged to history."""
+    owner = _scan_owner(scan_id)
+    # Claims are kept with the scan's owner; if the scan was pruned, look
+    # everywhere
+    paths = [_route(owner)] if owner is not None else None
+    parts = _scatter(lambda conn: conn.execute(
+        "SELECT detection_idx FROM scan_claims WHERE scan_id = ?", (scan_id,)
+    ).fetchall(), paths)
+    return {r["detection_idx"] for rows in parts for r in rows}
+
+
+def recompute_co2(factors: dict, version: int, default_factor: float = 0.1,
+                  chunk_size: int = 50_000, progress=None) -> int:
+    """
+    Re-derive co2_saved for every history row written under an older
+    factor table, using the stored weight_g and the given `factors`.
+
+    Works as a series of set-based UPDATEs over rowid ranges, committing
+    after each chunk, so the table is never loaded into Python and the
+    write lock is released regularly. Safe to re-run: rows already at
+    `version` are skipped. `progress(done_rowid, max_rowid)` is called
+    after each chunk if given (per history file, when sharded). Returns
+    the number of rows updated.
+    """
+    return sum(
+        _recompute_file(path, factors, version, default_factor,
+                        chunk_size, progress)
+        for path in _history_paths()
+    )
+
+
+def _recompute_file(path, factors, version, default_factor, chunk_size,
+                    progress) -> int:
+    updated = 0
+    with _get_conn(path) as conn:
+        conn.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS co2_factors "
+            "(material TEXT PRIMARY KEY, factor REAL NOT NULL)"
+        )
+        conn.execute("DELETE FROM co2_factors")
+        conn.executemany(
+            "INSERT INTO co2_factors (material, factor) VALUES (?, ?)",
+            [(m.lower(), f) for m, f in factors.items()]
+        )
+        lo, hi = conn.execute(
+            "SELECT MIN(rowid), MAX(rowid) FROM history"
+        ).fetchone()
+        if lo is None:
+            # Nothing raw in this file, but it may still hold roll-ups
+            lo, hi = 0, -1
+
+        for start in range(lo, hi + 1, chunk_size):
+            cur = conn.execute(
+                "UPDATE history SET "
+                "  co2_saved = ROUND(weight_g / 1000.0 * COALESCE("
+                "    (SELECT factor FROM co2_factors "
+                "     WHERE material = lower(history.material)), ?), 4), "
+                "  factor_version = ? "
+                "WHERE rowid >= ? AND rowid < ? AND factor_version < ?",
+                (default_factor, version, start, start + chunk_size, version)
+            )
+            conn.commit()
+            updated += cur.rowcount
+            if progress:
+                progress(min(start + chunk_size - 1, hi), hi)
+
+        # Compacted days: the stored weight sum makes this exact too. No
+        # trigger watches history_rollup, so move history_daily by the same
+        # delta here, in the same transaction.
+        new_co2 = ("ROUND({t}.weight_g / 1000.0 * COALESCE("
+                   "(SELECT factor FROM co2_factors "
+                   " WHERE material = lower({t}.material)), ?), 4)")
+        match = ("r.username = history_daily.username "
+                 "AND r.day = history_daily.day "
+                 "AND r.material = history_daily.material "
+                 "AND r.factor_version < ?")
+        conn.execute(
+            "UPDATE history_daily SET co2_saved = co2_saved + "
+            f"  (SELECT {new_co2.format(t='r')} - r.co2_saved "
+            f"   FROM history_rollup r WHERE {match}) "
+            f"WHERE EXISTS (SELECT 1 FROM history_rollup r WHERE {match})",
+            (default_factor, version, version)
+        )
+        cur = conn.execute(
+            "UPDATE history_rollup SET "
+            f"  co2_saved = {new_co2.format(t='history_rollup')}, "
+            "  factor_version = ? "
+            "WHERE factor_version < ?",
+            (default_factor, version, version)
+        )
+        conn.commit()
+        updated += cur.rowcount
+    return updated
+
+
+def claim_maintenance(task: str, interval_s: float) -> bool:
+    """
+    Return True if the caller should run `task` now, i.e. it has not been
+    started in the last `interval_s` seconds by any process using this
+    database. The check and the new timestamp are one write transaction,
+    so of several processes asking at once exactly one gets True.
+    """
+    with _get_conn() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO maintenance_runs (task) VALUES (?)", (task,)
+        )
+        cur = conn.execute(
+            "UPDATE maintenance_runs SET last_run = datetime('now') "
+            "WHERE task = ? AND (last_run IS NULL "
+            "                    OR last_run <= datetime('now', ?))",
+            (task, f"-{int(interval_s)} seconds")
+        )
+        conn.commit()
+    return cur.rowcount == 1
+
+
+def compact_history(retention_days: int = None, max_bytes: int = None,
+                    archive_path: str = None, chunk_size: int = 50_000) -> dict:
+    """
+    Roll raw history older than `retention_days` into history_rollup,
+    drop (or archive) the raw rows and reclaim the space.
+
+    Totals are preserved exactly: each chunk's rows are summed into their
+    (username, material, day) bucket and deleted in the same transaction.
+    With `archive_path`, raw rows are first copied to that SQLite file.
+    Scans past the horizon are pruned too, with their commit claims, so
+    duplicate-upload detection covers the retention window. If the files (main and any history
+    shards) are still larger than `max_bytes` in total, the horizon is
+    halved (down to one day) and the pass repeats. Returns a summary dict;
+    its "totals_mismatch" lists users whose daily totals no longer match
+    their rows (see verify_history_totals), and should be empty.
+    """
+    days = RETENTION_DAYS if retention_days is None else retention_days
+    limit = MAX_DB_BYTES if max_bytes is None else max_bytes
+    stats = {"rolled_up": 0, "scans_pruned": 0, "claims_pruned": 0,
+             "retention_days": days}
+
+    # DB_PATH (scans, and history when unsharded) plus any shard files;
+    # the size limit applies to all of them together
+    conns = [_get_conn(path)
+             for path in dict.fromkeys([DB_PATH] + _history_paths())]
+    main = conns[0]
+    try:
+        for conn in conns:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Pre-existing file: switching vacuum mode needs one full VACUUM
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+            if conn is not main:
+                # Shard files check their claims against DB_PATH's scans
+                conn.execute("ATTACH DATABASE ? AS core", (DB_PATH,))
+            if archive_path:
+                conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS archive.history AS "
+                    "SELECT * FROM main.history WHERE 0"
+                )
+                conn.commit()
+
+        while True:
+            cutoff = main.execute(
+                "SELECT date('now', ?)", (f"-{days} days",)
+            ).fetchone()[0]
+            for conn in conns:
+                stats["rolled_up"] += _compact_before(
+                    conn, cutoff, chunk_size, archive_path is not None
+                )
+            stats["scans_pruned"] += _delete_chunked(
+                main, "scans", "created < ?", (cutoff,), chunk_size
+            )
+            # Claims of pruned scans can never match again; left alone they
+            # would grow without bound (and reshards never move them)
+            for conn in conns:
+                scans = "main.scans" if conn is main else "core.scans"
+                stats["claims_pruned"] += _delete_chunked(
+                    conn, "scan_claims",
+                    f"scan_id NOT IN (SELECT id FROM {scans})", (), chunk_size
+                )
+            for conn in conns:
+                conn.execute("PRAGMA incremental_vacuum")
+                conn.commit()
+
+            size = sum(_db_size(conn) for conn in conns)
+            if size <= limit or days <= 1:
+                break
+            days = max(1, days // 2)
+            stats["retention_days"] = days
+
+        if archive_path:
+            for conn in conns:
+                conn.execute("DETACH DATABASE archive")
+    finally:
+        for conn in conns:
+            conn.close()
+
+    stats["db_bytes"] = size
+    stats["over_limit"] = size > limit
+    # Compaction must never change what the leaderboard shows
+    stats["totals_mismatch"] = verify_history_totals()
+    return stats
+
+
+def _compact_before(conn, cutoff: str, chunk_size: int, archive: bool) -> int:
+    """Roll up and delete raw rows before `cutoff`, one rowid range at a time."""
+    lo, hi = conn.execute(
+        "SELECT MIN(rowid), MAX(rowid) FROM history WHERE timestamp < ?",
+        (cutoff,)
+    ).fetchone()
+    if lo is None:
+        return 0
+
+    moved = 0
+    for start in range(lo, hi + 1, chunk_size):
+        where = "timestamp < ? AND rowid >= ? AND rowid < ?"
+        args = (cutoff, start, start + chunk_size)
+        # WHERE on the SELECT is required for the upsert to parse
+        conn.execute(
+            "INSERT INTO history_rollup "
+            "(username, material, day, items, co2_saved, weight_g, factor_version) "
+            "SELECT username, material, date(timestamp), COUNT(*), "
+            "       SUM(co2_saved), SUM(weight_g), MIN(factor_version) "
+            f"FROM history WHERE {where} "
+            "GROUP BY username, material, date(timestamp) "
+            "ON CONFLICT (username, material, day) DO UPDATE SET "
+            "  items          = items + excluded.items, "
+            "  co2_saved      = co2_saved + excluded.co2_saved, "
+            "  weight_g       = weight_g + excluded.weight_g, "
+            "  factor_version = MIN(factor_version, excluded.factor_version)",
+            args
+        )
+        if archive:
+            conn.execute(
+                f"INSERT INTO archive.history SELECT * FROM main.history "
+                f"WHERE {where}",
+                args
+            )
+        cur = conn.execute(f"DELETE FROM history WHERE {where}", args)
+        conn.commit()
+        moved += cur.rowcount
+    return moved
+
+
+def _delete_chunked(conn, table: str, where: str, args: tuple,
+                    chunk_size: int) -> int:
+    """DELETE in bounded batches so the write lock is never held for long."""
+    deleted = 0
+    while True:
+        cur = conn.execute(
+            f"DELETE FROM {table} WHERE rowid IN "
+            f"(SELECT rowid FROM {table} WHERE {where} LIMIT ?)",
+            args + (chunk_size,)
+        )
+        conn.commit()
+        deleted += cur.rowcount
+        if cur.rowcount < chunk_size:
+            return deleted
+
+
+def verify_history_totals(tolerance: float = 1e-6) -> list:
     """
+    Check that history_daily (which the leaderboard and Analytics tab
+    read) still sums to the raw and compacted rows behind it, per user and
+    history file. Each file is checked in one statement, so commits running
+    alongside cannot cause false alarms. Returns [(username, daily_co2,
+    actual_co2), ...] for every mismatch; empty when all totals agree.
+    """
+    parts = _scatter(lambda conn: conn.execute(
+        "SELECT username, SUM(daily_co2), SUM(actual_co2) FROM ("
+        "  SELECT username, co2_saved AS daily_co2, 0 AS actual_co2, "
+        "         items AS daily_items, 0 AS actual_items FROM history_daily "
+        "  UNION ALL "
+        "  SELECT username, 0, co2_saved, 0, items FROM history_all"
+        ") GROUP BY username "
+        "HAVING ABS(SUM(daily_co2) - SUM(actual_co2)) > ? "
+        "    OR SUM(daily_items) != SUM(actual_items)",
+        (tolerance,)
+    ).fetchall())
+    return [tuple(r) for rows in parts for r in rows]
+
+
+def _db_size(conn) -> int:
+    """Size in bytes of the main database file, excluding free pages."""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    pages = conn.execute("PRAGMA page_count").fetchone()[0]
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return (pages - free) * page_size
+
+
+# ------------------------------------------------------------------
+# RESHARDING
+# Online: the app keeps running. Each user is moved in one transaction
+# that holds the write lock of the file they leave and marks them in
+# shard_moved, so reads and writes follow them immediately. When every
+# user is across, the layout flips and a final sweep picks up anyone who
+# first wrote to an old file while the move was running.
+# ------------------------------------------------------------------
+def reshard(shards: int, progress=None) -> dict:
+    """
+    Move history to a layout of `shards` files (0 = back into DB_PATH).
+    Safe to interrupt and re-run with the same count. `progress(done,
+    total)` is called after each user moved. Returns a summary dict.
+    """
+    init_db()
+    layout = get_shard_layout()
+    if layout["target"] is not None and layout["target"] != shards:
+        raise ValueError(
+            f"A reshard to {layout['target']} shards is in progress; "
+            f"re-run it with --shards {layout['target']} first."
+        )
+    old = layout["shards"]
+    stats = {"from": old, "to": shards, "moved": 0, "swept": 0}
+    if old == shards:
+        return stats
+
+    for path in _layout_paths(shards):
+        if path != DB_PATH:
+            _init_history_file(path)
+    with _get_conn() as conn:
+        conn.execute("UPDATE shard_layout SET target = ?", (shards,))
+        conn.commit()
+
+    stats["moved"] = _rebalance(_layout_paths(old), shards, True, progress)
+
     with _get_conn() as conn:
+        conn.execute("UPDATE shard_layout SET shards = ?, target = NULL",
+                     (shards,))
+        conn.execute("DELETE FROM shard_moved")
+        conn.commit()
+
+    stats["swept"] = _rebalance(_layout_paths(old), shards, False, None)
+    return stats
+
+
+def _rebalance(paths, shards, mark, progress) -> int:
+    """Move every user found in `paths` whose home under `shards` is elsewhere."""
+    pending = []
+    for path in paths:
+        for username in _users_in(path):
+            home = _file_for(username, shards)
+            if home != path:
+                pending.append((username, path, home))
+    for done, (username, src, dst) in enumerate(pending, 1):
+        _move_user(username, src, dst, mark)
+        if progress:
+            progress(done, len(pending))
+    return len(pending)
+
+
+def _users_in(path) -> list:
+    """Users with history in a file, or owning scans whose claims are there."""
+    conn = _get_conn()
+    try:
+        schema = "main"
+        if path != DB_PATH:
+            conn.execute("ATTACH DATABASE ? AS shard", (path,))
+            schema = "shard"
         rows = conn.execute(
-            "SELECT username, SUM(co2_saved) AS total "
-            "FROM history "
-            "GROUP BY username "
-            "ORDER BY total DESC"
+            f"SELECT username FROM {schema}.history_daily "
+            f"UNION SELECT s.username FROM {schema}.scan_claims c "
+            f"JOIN main.scans s ON s.id = c.scan_id"
         ).fetchall()
-    return [(r["username"], r["total"]) for r in rows]
+    finally:
+        conn.close()
+    return [r[0] for r in rows]
+
+
+def _move_user(username: str, src: str, dst: str, mark: bool):
+    """
+    Move one user's history, roll-ups, daily totals and claims (for scans
+    they own) from `src` to `dst` in a single transaction. Merges with
+    anything already in `dst`; history_daily is rebuilt there by the
+    insert trigger plus the moved roll-ups, exactly as the v5 backfill.
+    """
+    conn = _get_conn()
+    try:
+        schemas = {}
+        for alias, path in (("src", src), ("dst", dst)):
+            if path == DB_PATH:
+                schemas[alias] = "main"
+            else:
+                conn.execute(f"ATTACH DATABASE ? AS {alias}", (path,))
+                schemas[alias] = alias
+        s, d = schemas["src"], schemas["dst"]
+        user = (username,)
+
+        conn.execute("BEGIN IMMEDIATE")
+        # Take the source's write lock before anything else: routed
+        # writers re-check their route once they get it
+        conn.execute(f"DELETE FROM {s}.history WHERE 0")
+
+        conn.execute(
+            f"INSERT INTO {d}.history ({_HISTORY_COLUMNS}) "
+            f"SELECT {_HISTORY_COLUMNS} FROM {s}.history "
+            f"WHERE username = ? ORDER BY id",
+            user
+        )
+        conn.execute(
+            f"INSERT INTO {d}.history_rollup "
+            "(username, material, day, items, co2_saved, weight_g, factor_version) "
+            "SELECT username, material, day, items, co2_saved, weight_g, "
+            "       factor_version "
+            f"FROM {s}.history_rollup WHERE username = ? "
+            "ON CONFLICT (username, material, day) DO UPDATE SET "
+            "  items          = items + excluded.items, "
+            "  co2_saved      = co2_saved + excluded.co2_saved, "
+            "  weight_g       = weight_g + excluded.weight_g, "
+            "  factor_version = MIN(factor_version, excluded.factor_version)",
+            user
+        )
+        conn.execute(
+            f"INSERT INTO {d}.history_daily "
+            "(username, day, material, items, co2_saved) "
+            "SELECT username, day, material, items, co2_saved "
+            f"FROM {s}.history_rollup WHERE username = ? "
+            "ON CONFLICT (username, day, material) DO UPDATE SET "
+            "  items     = items + excluded.items, "
+            "  co2_saved = co2_saved + excluded.co2_saved",
+            user
+        )
+        owned = (f"scan_id IN (SELECT id FROM main.scans "
+                 f"WHERE username = ?)")
+        conn.execute(
+            f"INSERT OR IGNORE INTO {d}.scan_claims "
+            f"SELECT * FROM {s}.scan_claims WHERE {owned}",
+            user
+        )
+
+        for table in ("history", "history_rollup", "history_daily"):
+            conn.execute(f"DELETE FROM {s}.{table} WHERE username = ?", user)
+        conn.execute(f"DELETE FROM {s}.scan_claims WHERE {owned}", user)
+        if mark:
+            conn.execute(
+                "INSERT OR IGNORE INTO main.shard_moved (username) VALUES (?)",
+                user
+            )
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
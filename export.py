@@ -0,0 +1,113 @@
+"""
+export.py — streaming history export for EcoScanner AI.
+
+Rows are pulled from SQLite in keyset-paged chunks (database.iter_history)
+and encoded chunk by chunk, so memory use does not depend on how many rows
+are exported. CSV and JSON Lines need only the standard library;
+Parquet is written one row group per chunk and needs `pyarrow`.
+"""
+
+import csv
+import io
+import itertools
+import json
+import tempfile
+
+from database import HISTORY_EXPORT_COLUMNS, iter_history
+
+FORMATS = {
+    "csv":     ("text/csv", "csv"),
+    "jsonl":   ("application/x-ndjson", "jsonl"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+CHUNK_ROWS = 5000
+
+
+def _chunks(rows, size=CHUNK_ROWS):
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def stream_csv(rows):
+    """Yield CSV bytes (header first), one chunk of rows at a time."""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(HISTORY_EXPORT_COLUMNS)
+    for chunk in _chunks(rows):
+        writer.writerows(chunk)
+        yield buf.getvalue().encode("utf-8")
+        buf.seek(0)
+        buf.truncate()
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def stream_jsonl(rows):
+    """Yield JSON Lines bytes, one object per row."""
+    for chunk in _chunks(rows):
+        yield "".join(
+            json.dumps(dict(zip(HISTORY_EXPORT_COLUMNS, r))) + "\n"
+            for r in chunk
+        ).encode("utf-8")
+
+
+def write_parquet(rows, fileobj):
+    """Write rows to `fileobj` as Parquet, one row group per chunk."""
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export requires pyarrow (pip install pyarrow)")
+
+    schema = pa.schema([
+        ("username", pa.string()),
+        ("material", pa.string()),
+        ("co2_saved", pa.float64()),
+        ("timestamp", pa.string()),
+        ("items", pa.int64()),
+    ])
+    with pq.ParquetWriter(fileobj, schema) as writer:
+        for chunk in _chunks(rows):
+            columns = list(zip(*chunk))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(col, type=field.type)
+                 for col, field in zip(columns, schema)],
+                schema=schema
+            ))
+
+
+def export_history(fmt: str, fileobj, **filters) -> None:
+    """
+    Export history in `fmt` ("csv", "jsonl" or "parquet") to a binary
+    file object. `filters` are passed to database.iter_history():
+    username, start, end, materials.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    rows = iter_history(**filters)
+    if fmt == "parquet":
+        write_parquet(rows, fileobj)
+        return
+    stream = stream_csv(rows) if fmt == "csv" else stream_jsonl(rows)
+    for block in stream:
+        fileobj.write(block)
+
+
+def export_to_tempfile(fmt: str, **filters):
+    """
+    Export to an anonymous temporary file on disk and return it rewound.
+    The export itself is never built in memory, but Streamlit reads the
+    whole file into memory when serving it, so hand it to
+    st.download_button as deferred data (read on click) and close it once
+    it is no longer offered. Unbuffered, because Streamlit only accepts
+    raw file objects.
+    """
+    tmp = tempfile.TemporaryFile(buffering=0)
+    export_history(fmt, tmp, **filters)
+    tmp.seek(0)
+    return tmp
@@ -0,0 +1,393 @@
+"""
+loadtest.py — multi-session load test for the EcoScanner AI app.
+
+Drives the real `app.py` script through Streamlit's in-process AppTest
+harness, one AppTest per simulated user, all in one process so they
+share the same st.cache_resource model, SQLite file and memory, just
+like sessions on a single Streamlit server. Each session:
+
+    load -> sign up -> log in -> (upload synthetic image -> commit) x K
+         -> refresh Analytics -> refresh Leaderboard
+
+Reports per-action latency percentiles, error counts (with "database is
+locked" and admission-control "server busy" broken out) and process RSS
+over time. Runs fully offline: by default a synthetic detector with a
+fixed per-image latency stands in for YOLO and is serialised like a
+single shared model instance; pass --real-model to use local weights
+instead.
+
+Usage:
+    python loadtest.py --sessions 50 --scans 3
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from collections import Counter, defaultdict
+
+import numpy as np
+import PIL.Image
+import PIL.ImageDraw
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+# ------------------------------------------------------------------
+# OFFLINE MODEL
+# ------------------------------------------------------------------
+class _Box:
+    def __init__(self, cls, conf, xyxy):
+        self.cls, self.conf, self.xyxy = [cls], [conf], [xyxy]
+
+
+class _Result:
+    def __init__(self, img, boxes):
+        self._img, self.boxes = img, boxes
+
+    def plot(self):
+        return self._img.copy()
+
+
+class SyntheticYOLO:
+    """
+    Stand-in for ultralytics.YOLO: fixed latency, a few plausible TACO
+    boxes per image. A class-wide lock makes concurrent sessions queue
+    for it the way they would for one real model instance.
+    """
+    latency_s = 0.05
+    _lock = threading.Lock()
+    names = {0: "Bottle", 1: "Drink can", 2: "Carton", 3: "Bottle cap",
+             4: "Glass bottle", 5: "Cigarette"}
+
+    def __init__(self, weights, *args, **kwargs):
+        self.weights = weights
+
+    def predict(self, source, conf=0.25, **kwargs):
+        with self._lock:
+            time.sleep(self.latency_s)
+        h, w = source.shape[:2]
+        rng = random.Random(int(source[::16, ::16].sum()))
+        boxes = []
+        for _ in range(rng.randint(1, 3)):
+            x1, y1 = rng.uniform(0, w * 0.6), rng.uniform(0, h * 0.6)
+            boxes.append(_Box(
+                rng.randrange(len(self.names)), rng.uniform(0.45, 0.95),
+                [x1, y1, x1 + rng.uniform(20, w * 0.4), y1 + rng.uniform(20, h * 0.4)]
+            ))
+        return [_Result(source, [b for b in boxes if b.conf[0] >= conf])]
+
+
+def install_synthetic_model(latency_ms: float):
+    """Make `from ultralytics import YOLO` (in logic.py) resolve to SyntheticYOLO."""
+    SyntheticYOLO.latency_s = latency_ms / 1000
+    module = types.ModuleType("ultralytics")
+    module.YOLO = SyntheticYOLO
+    sys.modules["ultralytics"] = module
+
+
+def synthetic_image(rng: random.Random, size=(640, 480)) -> bytes:
+    """A unique PNG with a few coloured shapes on a cluttered, noisy gradient."""
+    w, h = size
+    base = np.linspace(rng.randint(0, 120), rng.randint(120, 255), w, dtype=np.uint8)
+    img = PIL.Image.fromarray(np.dstack([np.tile(base, (h, 1))] * 3))
+    draw = PIL.ImageDraw.Draw(img)
+    # Ground clutter: real photos of litter are full of small edges, and
+    # ImageGate's blur check is calibrated on them
+    for _ in range(300):
+        x, y = rng.randrange(w), rng.randrange(h)
+        shade = rng.randrange(256)
+        draw.line([x, y, x + rng.randint(-12, 12), y + rng.randint(-12, 12)],
+                  fill=(shade, shade, shade), width=rng.randint(1, 3))
+    for _ in range(rng.randint(2, 6)):
+        x, y = rng.randrange(w - 60), rng.randrange(h - 60)
+        draw.rectangle(
+            [x, y, x + rng.randint(20, 200), y + rng.randint(20, 200)],
+            fill=tuple(rng.randrange(256) for _ in range(3))
+        )
+    # Mild sensor-like noise, as in a real camera frame
+    noise = np.random.default_rng(rng.randrange(2**32)).normal(0, 6, (h, w, 3))
+    img = PIL.Image.fromarray(
+        np.clip(np.asarray(img, dtype=np.float32) + noise, 0, 255).astype(np.uint8)
+    )
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+# ------------------------------------------------------------------
+# METRICS
+# ------------------------------------------------------------------
+class Metrics:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.errors = Counter()
+        self.rss = []
+        self._lock = threading.Lock()
+
+    def record(self, action, ms, errors=()):
+        with self._lock:
+            self.latency[action].append(ms)
+            for e in errors:
+                self.errors[_classify(e)] += 1
+
+
+def _classify(message: str) -> str:
+    text = message.lower()
+    if "database is locked" in text:
+        return "database is locked"
+    if "server busy" in text:
+        return "server busy (admission control)"
+    if "timed out" in text or "timeout" in text:
+        return "timeout"
+    return message.splitlines()[0][:80] if message else "unknown"
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+    except OSError:
+        import resource
+        # ru_maxrss: peak, in KiB on Linux and bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1e6 if sys.platform == "darwin" else 1e3)
+
+
+def _sample_rss(metrics: Metrics, stop: threading.Event, interval: float):
+    started = time.time()
+    while not stop.is_set():
+        metrics.rss.append((round(time.time() - started, 1), round(_rss_mb(), 1)))
+        stop.wait(interval)
+
+
+# ------------------------------------------------------------------
+# CONCURRENT APPTEST
+# AppTest is built for one test at a time: every run installs a fresh
+# mock Runtime singleton and a config patch, then clears both when it
+# finishes, which breaks any other session still running. Install one
+# shared mock runtime for the whole load test instead (this also shares
+# st.cache_data, as sessions on a real server do) and neutralise the
+# per-run swaps.
+# ------------------------------------------------------------------
+def enable_concurrent_apptest():
+    import contextlib
+    from unittest.mock import MagicMock
+
+    from streamlit.testing.v1 import app_test, local_script_runner
+    from streamlit.runtime import Runtime
+
+    shared = MagicMock(spec=Runtime)
+    shared.media_file_mgr = app_test.MediaFileManager(
+        app_test.MemoryMediaFileStorage("/mock/media")
+    )
+    shared.dataframe_source_mgr = app_test.DataframeSourceManager()
+    shared.cache_storage_manager = app_test.MemoryCacheStorageManager()
+    Runtime._instance = shared
+
+    class _PerRunRuntime(Runtime):
+        """Absorbs AppTest's per-run `Runtime._instance = ...` writes."""
+
+    app_test.Runtime = _PerRunRuntime
+
+    # Compile app.py once; concurrent ast.parse calls are not thread-safe
+    script_cache = app_test.ScriptCache()
+    script_cache.get_bytecode(APP_PATH)
+    app_test.ScriptCache = lambda: script_cache
+    local_script_runner.ScriptCache = lambda: script_cache
+
+    # Reference-counted config patch: applied by the first running
+    # session, undone only when the last one finishes
+    original_patch = app_test.patch_config_options
+    lock = threading.Lock()
+    state = {"active": 0, "patch": None}
+
+    @contextlib.contextmanager
+    def shared_patch(options):
+        with lock:
+            if state["active"] == 0:
+                state["patch"] = original_patch(options)
+                state["patch"].__enter__()
+            state["active"] += 1
+        try:
+            yield
+        finally:
+            with lock:
+                state["active"] -= 1
+                if state["active"] == 0:
+                    state["patch"].__exit__(None, None, None)
+
+    app_test.patch_config_options = shared_patch
+
+
+# ------------------------------------------------------------------
+# SESSION SCRIPT
+# ------------------------------------------------------------------
+def _button(at, label=None, key=None):
+    for b in at.button:
+        if (key is not None and b.key == key) or (label is not None and b.label == label):
+            return b
+    return None
+
+
+def _errors(at):
+    found = [e.value for e in at.exception]
+    found += [e.value for e in at.error]
+    # Admission-control rejections are warnings in the UI, but count here
+    found += [w.value for w in at.warning if "Server busy" in w.value]
+    return found
+
+
+def _step(metrics, at, action, fn, timeout):
+    started = time.perf_counter()
+    try:
+        fn()
+        at.run(timeout=timeout)
+        errors = _errors(at)
+    except Exception as e:
+        errors = [str(e) or type(e).__name__]
+    metrics.record(action, (time.perf_counter() - started) * 1000, errors)
+    return not errors
+
+
+def run_session(idx: int, args, metrics: Metrics):
+    from streamlit.testing.v1 import AppTest
+
+    rng = random.Random(args.seed * 1000 + idx)
+    user, password = f"load_{args.seed}_{idx}", "loadtest-pw"
+    at = AppTest.from_file(APP_PATH, default_timeout=args.timeout)
+
+    if not _step(metrics, at, "load", lambda: None, args.timeout):
+        return
+
+    def signup():
+        at.text_input(key="s_user").input(user)
+        at.text_input(key="s_pass").input(password)
+        at.text_input(key="s_email").input(f"{user}@example.org")
+        _button(at, label="Initialize Profile").click()
+    _step(metrics, at, "signup", signup, args.timeout)
+
+    def login():
+        at.text_input(key="l_user").input(user)
+        at.text_input(key="l_pass").input(password)
+        _button(at, label="Authenticate Identity").click()
+    if not _step(metrics, at, "login", login, args.timeout):
+        return
+
+    for n in range(args.scans):
+        image = synthetic_image(rng)
+        _step(metrics, at, "upload", lambda: at.file_uploader[0].set_value(
+            (f"scan_{idx}_{n}.png", image, "image/png")), args.timeout)
+        commit = next((b for b in at.button if b.key and b.key.startswith("save_")), None)
+        if commit is not None:
+            _step(metrics, at, "commit", commit.click, args.timeout)
+
+    _step(metrics, at, "analytics",
+          lambda: _button(at, key="refresh_stats").click(), args.timeout)
+    _step(metrics, at, "leaderboard",
+          lambda: _button(at, key="refresh_ranks").click(), args.timeout)
+
+
+# ------------------------------------------------------------------
+# REPORT
+# ------------------------------------------------------------------
+def _pct(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def report(metrics: Metrics, wall_s: float, sessions: int) -> dict:
+    summary = {
+        "sessions": sessions,
+        "wall_s": round(wall_s, 1),
+        "actions": {
+            action: {
+                "n": len(v),
+                "p50_ms": round(_pct(v, 50), 1),
+                "p90_ms": round(_pct(v, 90), 1),
+                "p99_ms": round(_pct(v, 99), 1),
+                "max_ms": round(max(v), 1),
+            }
+            for action, v in metrics.latency.items()
+        },
+        "errors": dict(metrics.errors),
+        "rss_mb": metrics.rss,
+    }
+
+    print(f"\n{sessions} sessions in {wall_s:.1f} s\n")
+    print(f"{'action':<12}{'n':>6}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for action, s in summary["actions"].items():
+        print(f"{action:<12}{s['n']:>6}{s['p50_ms']:>10}{s['p90_ms']:>10}"
+              f"{s['p99_ms']:>10}{s['max_ms']:>10}")
+    print("\nerrors:", "none" if not metrics.errors else "")
+    for kind, count in metrics.errors.most_common():
+        print(f"  {count:>5}  {kind}")
+    if metrics.rss:
+        step = max(1, len(metrics.rss) // 10)
+        print("\nRSS over time (s: MB):",
+              "  ".join(f"{t}: {mb}" for t, mb in metrics.rss[::step]))
+        print(f"RSS start {metrics.rss[0][1]} MB, peak "
+              f"{max(mb for _, mb in metrics.rss)} MB, end {metrics.rss[-1][1]} MB")
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EcoScanner AI load test")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--scans", type=int, default=3, help="uploads per session")
+    parser.add_argument("--ramp-s", type=float, default=2.0,
+                        help="spread session start-up over this many seconds")
+    parser.add_argument("--timeout", type=float, default=120.0,
+                        help="per-action timeout in seconds")
+    parser.add_argument("--model-latency-ms", type=float, default=50.0,
+                        help="synthetic detector time per image")
+    parser.add_argument("--real-model", action="store_true",
+                        help="use local YOLO weights instead of the synthetic detector")
+    parser.add_argument("--db", help="SQLite file (default: fresh temp file)")
+    parser.add_argument("--rss-interval", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=int(time.time()) % 100000)
+    parser.add_argument("--json", help="also write the summary to this file")
+    args = parser.parse_args(argv)
+
+    if not args.real_model:
+        install_synthetic_model(args.model_latency_ms)
+
+    import database
+    database.DB_PATH = args.db or os.path.join(
+        tempfile.mkdtemp(prefix="ecoscanner-load-"), "load.db"
+    )
+    print(f"Database: {database.DB_PATH}")
+    enable_concurrent_apptest()
+
+    metrics = Metrics()
+    stop = threading.Event()
+    sampler = threading.Thread(
+        target=_sample_rss, args=(metrics, stop, args.rss_interval), daemon=True
+    )
+    sampler.start()
+
+    started = time.time()
+    threads = []
+    for i in range(args.sessions):
+        t = threading.Thread(target=run_session, args=(i, args, metrics))
+        t.start()
+        threads.append(t)
+        time.sleep(args.ramp_s / max(1, args.sessions))
+    for t in threads:
+        t.join()
+    stop.set()
+    sampler.join()
+
+    summary = report(metrics, time.time() - started, args.sessions)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,17 @@
 import os
+import threading
 import PIL.Image
+import PIL.ImageDraw
 import numpy as np
-from ultralytics import YOLO
 
 class EcoImpact:
+    # Bump whenever self.factors changes. Every history row stores the
+    # version it was computed with so database.recompute_co2() can bring
+    # old rows up to date instead of leaving them frozen at stale values.
+    FACTOR_VERSION = 1
+    DEFAULT_FACTOR = 0.1
+    DEFAULT_WEIGHT_G = 25.0
+
     def __init__(self):
         # CO2 saved per kg of recycled material (Global Standards)
         self.factors = {
@@ -13,16 +21,214 @@ class EcoImpact:
             'glass': 0.5, 
             'metal': 6.5
         }
+        # Typical item weight (g) for an object filling `reference_area`
+        # of the frame; used when estimating weight from box size.
+        self.weights = {
+            'aluminum': 15.0,
+            'plastic': 25.0,
+            'paper': 10.0,
+            'glass': 200.0,
+            'metal': 15.0
+        }
+        self.reference_area = 0.1
 
     def calculate(self, material, weight_g=25):
         """Calculates CO2 savings based on detected material and average weight."""
         return round((weight_g / 1000) * self.factors.get(material.lower(), 0.1), 4)
 
+    def calculate_many(self, materials, weights_g=None, areas=None):
+        """
+        Vectorised calculate() for a whole detection array in one call.
+        `areas` (box area as a fraction of the frame) switches on per-item
+        weight estimation; otherwise `weights_g` or the 25 g default is used.
+        Returns (co2_kg, weights_g) as float arrays aligned with `materials`.
+        """
+        materials = np.asarray(materials, dtype=str)
+        if materials.size == 0:
+            return np.zeros(0), np.zeros(0)
+
+        # Look each distinct material up once, then broadcast back
+        keys, inverse = np.unique(np.char.lower(materials), return_inverse=True)
+        factors = np.array(
+            [self.factors.get(k, self.DEFAULT_FACTOR) for k in keys]
+        )[inverse]
+
+        if areas is not None:
+            nominal = np.array(
+                [self.weights.get(k, self.DEFAULT_WEIGHT_G) for k in keys]
+            )[inverse]
+            scale = np.clip(
+                np.asarray(areas, dtype=float) / self.reference_area, 0.25, 4.0
+            )
+            weights = np.round(nominal * scale, 1)
+        elif weights_g is None:
+            weights = np.full(materials.shape, self.DEFAULT_WEIGHT_G)
+        else:
+            weights = np.broadcast_to(
+                np.asarray(weights_g, dtype=float), materials.shape
+            )
+
+        return np.round(weights / 1000 * factors, 4), weights
+
+class ImageRejected(ValueError):
+    """Raised by ImageGate when an upload should be retaken, not scanned."""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+class ImageGate:
+    """
+    Cheap pre-inference checks. Blur, exposure and entropy are measured on
+    a ~256 px grayscale copy (decoded at reduced scale for JPEGs), so an
+    upload that is certain to come back empty costs a few milliseconds
+    instead of a model run. Oversized photos are downscaled before
+    inference, or rejected outright above `max_pixels`.
+    """
+    REASONS = ("too_large", "blank", "too_dark", "overexposed", "blurry")
+    PROBE_SIDE = 256
+
+    def __init__(self, min_sharpness=60.0, min_entropy=2.5,
+                 dark_level=40, bright_level=215,
+                 max_side=1920, max_pixels=60_000_000):
+        # Variance of the Laplacian on the probe. Measured on real 640-720 px
+        # frames (TACO tiles, product photos): sharp 500-6400, Gaussian blur
+        # sigma=2 87-720, sigma=3 29-180, sigma=4 12-57. 60 rejects sigma>=4.
+        self.min_sharpness = min_sharpness
+        self.min_entropy = min_entropy      # bits, of the 256-bin histogram
+        # Exposure, on 0-255 luminance: too dark if 95% of pixels are below
+        # dark_level, overexposed if 95% are above bright_level. Percentiles
+        # rather than the mean, so objects on white or black backdrops pass.
+        self.dark_level = dark_level
+        self.bright_level = bright_level
+        self.max_side = max_side
+        self.max_pixels = max_pixels
+        self.stats = {"checked": 0, **{r: 0 for r in self.REASONS}}
+        self._stats_lock = threading.Lock()
+
+    def measure(self, image_file, size_only=False):
+        """
+        Returns {"size", "sharpness", "p5", "p95", "entropy"}; only "size"
+        with `size_only` or if the image is over max_pixels (it is then
+        never decoded, only its header read).
+        """
+        image_file.seek(0)
+        img = PIL.Image.open(image_file)
+        size = img.size  # before draft() shrinks it
+        if size_only or size[0] * size[1] > self.max_pixels:
+            return {"size": size}
+
+        img.draft("L", (self.PROBE_SIDE, self.PROBE_SIDE))
+        probe = img.convert("L")
+        probe.thumbnail((self.PROBE_SIDE, self.PROBE_SIDE), PIL.Image.BILINEAR)
+        g = np.asarray(probe, dtype=np.float32)
+
+        # 4-neighbour Laplacian on the interior, no SciPy/OpenCV needed
+        lap = (g[:-2, 1:-1] + g[2:, 1:-1] + g[1:-1, :-2] + g[1:-1, 2:]
+               - 4 * g[1:-1, 1:-1])
+        hist = np.bincount(g.astype(np.uint8).ravel(), minlength=256)
+        p = hist[hist > 0] / g.size
+        p5, p95 = np.percentile(g, (5, 95))
+        return {
+            "size": size,
+            "sharpness": float(lap.var()),
+            "p5": float(p5),
+            "p95": float(p95),
+            "entropy": float(-(p * np.log2(p)).sum()),
+        }
+
+    def check(self, image_file, size_only=False):
+        """
+        Raises ImageRejected if the upload is not worth running the model on.
+        With `size_only`, only the pixel limit is checked, from the header;
+        an image that passes it is not counted until the full check.
+        """
+        m = self.measure(image_file, size_only)
+        w, h = m["size"]
+        reason = None
+        if w * h > self.max_pixels:
+            reason, message = "too_large", (
+                f"Image is {w}x{h} ({w * h / 1e6:.0f} MP); "
+                f"the limit is {self.max_pixels / 1e6:.0f} MP."
+            )
+        elif size_only:
+            return
+        elif m["entropy"] < self.min_entropy:
+            reason, message = "blank", "Image looks blank (almost no detail)."
+        elif m["p95"] < self.dark_level:
+            reason, message = "too_dark", "Image is too dark."
+        elif m["p5"] > self.bright_level:
+            reason, message = "overexposed", "Image is overexposed."
+        elif m["sharpness"] < self.min_sharpness:
+            reason, message = "blurry", "Image is too blurry (motion or focus blur)."
+
+        with self._stats_lock:
+            self.stats["checked"] += 1
+            if reason:
+                self.stats[reason] += 1
+        if reason:
+            raise ImageRejected(reason, message)
+
+    def open(self, image_file):
+        """
+        Decode as RGB, downscaled so the long side is at most max_side.
+        Returns (img, scale): scale is the decoded size over the original
+        (1.0 if the image was small enough already).
+        """
+        image_file.seek(0)
+        img = PIL.Image.open(image_file)
+        side = max(img.size)
+        if side > self.max_side:
+            img.draft("RGB", (self.max_side, self.max_side))
+            img = img.convert("RGB")
+            img.thumbnail((self.max_side, self.max_side), PIL.Image.BILINEAR)
+        return img.convert("RGB"), max(img.size) / side
+
 class EcoScannerAI:
-    def __init__(self):
-        # Uses your custom-trained 'best.pt' if found
-        weights = 'best.pt' if os.path.exists('best.pt') else 'yolov8s.pt'
-        self.model = YOLO(weights) 
+    # Cascade: stage-1 detections with confidence in [low, high) are
+    # "uncertain" and send the image on to the full model
+    UNCERTAINTY_BAND = (0.25, 0.6)
+
+    @staticmethod
+    def parse_band(text):
+        """Parse a "low,high" uncertainty band, e.g. "0.25,0.6"."""
+        try:
+            low, high = (float(v) for v in text.split(","))
+        except ValueError:
+            raise ValueError(f"expected LOW,HIGH confidences, got {text!r}") from None
+        if not 0 <= low < high <= 1:
+            raise ValueError(f"need 0 <= low < high <= 1, got {text!r}")
+        return low, high
+
+    def __init__(self, server_address=None, cascade=False,
+                 uncertainty_band=UNCERTAINTY_BAND, gate=None):
+        # With a server address this is a thin client of model_server.py:
+        # no weights or torch runtime are loaded in this process.
+        self.client = None
+        # Optional ImageGate: rejects blank/blurry/huge uploads before inference
+        self.gate = gate
+        self.model = None
+        self.fast_model = None
+        self.uncertainty_band = uncertainty_band
+        self.cascade_stats = {"scans": 0, "escalated": 0}
+        self._stats_lock = threading.Lock()
+        if server_address:
+            from model_server import ModelClient
+            self.client = ModelClient(server_address)
+        else:
+            from ultralytics import YOLO
+
+            # Uses your custom-trained 'best.pt' if found
+            weights = 'best.pt' if os.path.exists('best.pt') else 'yolov8s.pt'
+            self.model = YOLO(weights) 
+
+            if cascade:
+                # Nano first stage; must share the full model's label set
+                fast = 'best_n.pt' if os.path.exists('best_n.pt') else 'yolov8n.pt'
+                self.fast_model = YOLO(fast)
+                if self.fast_model.names != self.model.names:
+                    print(f"Cascade disabled: {fast} and {weights} have different classes")
+                    self.fast_model = None
         
         # Comprehensive TACO Class Mapping
         # This maps specific labels to general material categories for CO2 math
@@ -45,41 +251,128 @@ class EcoScannerAI:
             'Water bottle': 'plastic'
         }
 
-    def process(self, image_file):
-        """Processes an image with logic to correct mislabeled large items."""
-        try:
+    def detect(self, img_array):
+        """
+        Runs the local model on an RGB array.
+        Returns (records, results): compact {"label", "confidence", "box"}
+        dicts for every box, plus the raw Ultralytics results.
+
+        In cascade mode the fast model runs first and its answer is kept
+        unless it found nothing or any box falls inside the uncertainty
+        band, in which case the full model decides.
+        """
+        if self.fast_model is not None:
+            low, high = self.uncertainty_band
+            fast = self.fast_model.predict(source=img_array, conf=low, iou=0.5, save=False)
+            confs = [float(box.conf[0]) for r in fast for box in r.boxes]
+            escalate = not confs or any(c < high for c in confs)
+            with self._stats_lock:
+                self.cascade_stats["scans"] += 1
+                self.cascade_stats["escalated"] += int(escalate)
+            if not escalate:
+                # Every box is >= high, so already above the full model's 0.4
+                return self._records(fast, self.fast_model.names), fast
+
+        # Use a slightly higher confidence (0.4) to ignore weak 'hallucinations'
+        results = self.model.predict(source=img_array, conf=0.4, iou=0.5, save=False)
+        return self._records(results, self.model.names), results
+
+    @staticmethod
+    def _records(results, names):
+        records = []
+        for r in results:
+            for box in r.boxes:
+                records.append({
+                    "label": names[int(box.cls[0])],
+                    "confidence": float(box.conf[0]),
+                    "box": [round(float(c), 1) for c in box.xyxy[0]]  # [x1, y1, x2, y2]
+                })
+        return records
+
+    def process(self, image_file, checked=False):
+        """
+        Processes an image with logic to correct mislabeled large items.
+        Raises ImageRejected (without running the model) if the gate
+        decides the upload needs a retake; pass checked=True if the caller
+        already ran gate.check() on it. Model and model-server errors
+        propagate: an empty list always means "nothing detected".
+        """
+        scale = 1.0
+        if self.gate is not None:
+            if not checked:
+                self.gate.check(image_file)
+            img, scale = self.gate.open(image_file)
+        else:
             img = PIL.Image.open(image_file).convert("RGB")
-            img_array = np.array(img)
-            
-            # Use a slightly higher confidence (0.4) to ignore weak 'hallucinations'
-            results = self.model.predict(source=img_array, conf=0.4, iou=0.5, save=False)
+        img_array = np.array(img)
+
+        if self.client is not None:
+            records = self.client.detect(img_array)
+            annotated_img = self._draw(img, records)
+        else:
+            records, results = self.detect(img_array)
+            annotated_img = results[0].plot()
+
+        detections = self._postprocess(records, img_array.shape, scale)
+        return detections, annotated_img
+
+    def _postprocess(self, records, shape, scale=1.0):
+        """
+        Maps raw model records to recyclable material detections. `scale`
+        is the size the image was run at over the uploaded size.
+        """
+        detections = []
+        frame_area = float(shape[0] * shape[1])
+
+        for rec in records:
+            label = rec["label"]
+
+            # Calculate box size (width * height)
+            x1, y1, x2, y2 = rec["box"]
+            area = (x2 - x1) * (y2 - y1)
+
+            # LOGIC OVERRIDE: If the object is huge but labeled 'Bottle cap', 
+            # it's clearly a jug/container. Measured in pixels of the
+            # uploaded photo, so the gate's downscaling doesn't move it.
+            if label == "Bottle cap" and area / (scale * scale) > 10000:
+                label = "Plastic container"
             
-            detections = []
-            annotated_img = results[0].plot() 
-
-            for r in results:
-                for box in r.boxes:
-                    label = self.model.names[int(box.cls[0])]
-                    conf = float(box.conf[0])
-                    
-                    # Calculate box size (width * height)
-                    coords = box.xyxy[0] # [x1, y1, x2, y2]
-                    width = coords[2] - coords[0]
-                    height = coords[3] - coords[1]
-                    area = width * height
-
-                    # LOGIC OVERRIDE: If the object is huge but labeled 'Bottle cap', 
-                    # it's clearly a jug/container.
-                    if label == "Bottle cap" and area > 10000:
-                        label = "Plastic container"
-                    
-                    if label in self.trash_map:
-                        detections.append({
-                            "label": label, 
-                            "material": self.trash_map[label],
-                            "confidence": conf
-                        })
-            return detections, annotated_img
-        except Exception as e:
-            print(f"Logic Error: {e}")
-            return [], None
\ No newline at end of file
+            if label in self.trash_map:
+                detections.append({
+                    "label": label, 
+                    "material": self.trash_map[label],
+                    "confidence": rec["confidence"],
+                    "area": float(area) / frame_area,
+                    "box": rec["box"]
+                })
+        return detections
+
+    def render(self, image_file, detections, source_size=None):
+        """
+        Draw stored detections onto the image without running the model.
+        Used when a scan is served from the duplicate-upload index;
+        `source_size` is the (width, height) the boxes were measured on.
+        """
+        img = PIL.Image.open(image_file).convert("RGB")
+        scale = (1.0, 1.0)
+        if source_size and all(source_size):
+            scale = (img.size[0] / source_size[0], img.size[1] / source_size[1])
+        return self._draw(img, detections, scale)
+
+    def _draw(self, img, detections, scale=(1.0, 1.0)):
+        """Draws labelled boxes on a PIL image; returns an RGB array."""
+        sx, sy = scale
+        draw = PIL.ImageDraw.Draw(img)
+        width = max(2, round(max(img.size) / 400))
+        for det in detections:
+            if "box" not in det:
+                continue
+            x1, y1, x2, y2 = det["box"]
+            x1, x2, y1, y2 = x1 * sx, x2 * sx, y1 * sy, y2 * sy
+            draw.rectangle([x1, y1, x2, y2], outline=(16, 185, 129), width=width)
+            draw.text(
+                (x1 + width, max(0, y1 - 12)),
+                f"{det['label']} {det['confidence']:.2f}",
+                fill=(16, 185, 129)
+            )
+        return np.array(img)
@@ -0,0 +1,232 @@
+"""
+manage.py — EcoScanner AI maintenance jobs.
+
+Usage:
+    python manage.py recompute [--chunk-size N]
+    python manage.py compact [--days N] [--max-mb N] [--archive FILE]
+    python manage.py export --format csv|jsonl|parquet [--user NAME]
+                            [--start DATE] [--end DATE] [--material M ...]
+                            [-o FILE]
+    python manage.py reshard --shards N
+    python manage.py selfcheck [--rows N]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import database
+
+
+def cmd_recompute(args):
+    """Re-derive stored CO2 values with the current EcoImpact factor table."""
+    from logic import EcoImpact
+
+    impact = EcoImpact()
+
+    def progress(done, total):
+        print(f"  rowid {done}/{total}", file=sys.stderr)
+
+    database.init_db()
+    updated = database.recompute_co2(
+        impact.factors,
+        impact.FACTOR_VERSION,
+        default_factor=impact.DEFAULT_FACTOR,
+        chunk_size=args.chunk_size,
+        progress=progress
+    )
+    print(f"Recomputed {updated} history rows "
+          f"(factor table v{impact.FACTOR_VERSION}).")
+
+
+def cmd_compact(args):
+    """Roll old history into per-day totals and reclaim database space."""
+    database.init_db()
+    stats = database.compact_history(
+        retention_days=args.days,
+        max_bytes=int(args.max_mb * 1024 * 1024) if args.max_mb else None,
+        archive_path=args.archive,
+        chunk_size=args.chunk_size
+    )
+    print(f"Rolled up {stats['rolled_up']} rows, pruned "
+          f"{stats['scans_pruned']} scans ({stats['claims_pruned']} claims); "
+          f"horizon {stats['retention_days']} "
+          f"days, database {stats['db_bytes'] / 1e6:.1f} MB"
+          + ("  (STILL OVER LIMIT)" if stats["over_limit"] else ""))
+    if stats["totals_mismatch"]:
+        for username, daily, actual in stats["totals_mismatch"]:
+            print(f"  TOTALS MISMATCH {username}: daily {daily} kg, "
+                  f"rows {actual} kg", file=sys.stderr)
+        sys.exit(1)
+
+
+def cmd_export(args):
+    """Stream history (one user or everyone) to a CSV/JSONL/Parquet file."""
+    from export import export_history
+
+    filters = {"username": args.user, "start": args.start, "end": args.end,
+               "materials": args.material}
+    if args.output == "-":
+        export_history(args.format, sys.stdout.buffer, **filters)
+    else:
+        with open(args.output, "wb") as f:
+            export_history(args.format, f, **filters)
+
+
+def cmd_reshard(args):
+    """Move history to N shard files (0 = back into the main database), online."""
+    def progress(done, total):
+        if done % 100 == 0 or done == total:
+            print(f"  moved {done}/{total} users", file=sys.stderr)
+
+    stats = database.reshard(args.shards, progress=progress)
+    if stats["from"] == stats["to"]:
+        print(f"History is already in {stats['to']} shard(s).")
+        return
+    print(f"Resharded history {stats['from']} -> {stats['to']}: moved "
+          f"{stats['moved']} users, swept {stats['swept']} late writers.")
+
+
+def cmd_selfcheck(args):
+    """Run compaction, recompute and reshards on a scratch database and check totals."""
+    from logic import EcoImpact
+
+    impact = EcoImpact()
+    rng = random.Random(0)
+    failures = 0
+
+    def check(step, expected):
+        nonlocal failures
+        mismatch = database.verify_history_totals()
+        totals = dict(database.get_all_user_stats())
+        drift = {u: (t, totals.get(u, 0.0)) for u, t in expected.items()
+                 if abs(totals.get(u, 0.0) - t) > 1e-6}
+        ok = not mismatch and not drift and totals.keys() == expected.keys()
+        print(f"  {'ok  ' if ok else 'FAIL'} {step}")
+        for username, daily, actual in mismatch:
+            print(f"       {username}: daily {daily} kg, rows {actual} kg")
+        for username, (was, now) in drift.items():
+            print(f"       {username}: leaderboard {was} -> {now} kg")
+        failures += not ok
+
+    def seed(conn, rows, days):
+        # Whole-gram weights keep every CO2 value exact at 4 decimals, so
+        # recompute (same factors, newer version) must not move any total
+        materials = sorted(impact.factors)
+        history = []
+        for _ in range(rows):
+            material = rng.choice(materials)
+            weight = rng.randint(5, 300)
+            history.append((
+                f"user{rng.randrange(20)}", material,
+                impact.calculate(material, weight), weight,
+                impact.FACTOR_VERSION - 1,
+                f"-{rng.randrange(days * 86400)} seconds"
+            ))
+        conn.executemany(
+            "INSERT INTO history (username, material, co2_saved, weight_g, "
+            "factor_version, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, datetime('now', ?))",
+            history
+        )
+        conn.commit()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_PATH = os.path.join(tmp, "selfcheck.db")
+        database.HISTORY_SHARDS = 0
+        database.init_db()
+        # Committed scans, so compaction has claims to prune
+        for i in range(50):
+            scan_id = database.add_scan(f"user{i % 20}", f"selfcheck{i}",
+                                        i, [], 1, 1)
+            database.add_history(f"user{i % 20}", "plastic", 0.0375,
+                                 scan_id=scan_id, detection_idx=0)
+        with database._get_conn() as conn:
+            conn.execute("UPDATE scans SET created = datetime('now', "
+                         "'-' || (id * 4) || ' days')")
+            seed(conn, args.rows, 200)
+
+        expected = dict(database.get_all_user_stats())
+        print(f"Scratch database: {args.rows + 50} rows, "
+              f"{len(expected)} users")
+        check("seeded", expected)
+
+        chunk = max(1, args.rows // 7)
+        for days in (150, 90, 30):
+            database.compact_history(retention_days=days, chunk_size=chunk)
+            check(f"compact --days {days} (chunks of {chunk})", expected)
+        # Late rows for days that are already compacted must merge into
+        # the existing roll-ups on the next pass, not count twice
+        with database._get_conn() as conn:
+            seed(conn, args.rows // 10, 200)
+        expected = dict(database.get_all_user_stats())
+        database.compact_history(retention_days=30, chunk_size=chunk)
+        check("compact again after late rows", expected)
+
+        updated = database.recompute_co2(
+            impact.factors, impact.FACTOR_VERSION,
+            default_factor=impact.DEFAULT_FACTOR, chunk_size=chunk
+        )
+        check(f"recompute ({updated} rows)", expected)
+
+        for shards in (3, 2):
+            database.reshard(shards)
+            check(f"reshard -> {shards}", expected)
+        database.compact_history(retention_days=7, chunk_size=chunk)
+        check("compact --days 7 (sharded)", expected)
+
+    if failures:
+        print(f"{failures} check(s) failed.", file=sys.stderr)
+        sys.exit(1)
+    print("All checks passed.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EcoScanner AI maintenance")
+    parser.add_argument("--db", help="SQLite file to operate on "
+                        f"(default: {database.DB_PATH})")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("recompute", help=cmd_recompute.__doc__)
+    p.add_argument("--chunk-size", type=int, default=50_000)
+    p.set_defaults(func=cmd_recompute)
+
+    p = sub.add_parser("compact", help=cmd_compact.__doc__)
+    p.add_argument("--days", type=int,
+                   help=f"retention horizon (default {database.RETENTION_DAYS})")
+    p.add_argument("--max-mb", type=float, help="database size ceiling")
+    p.add_argument("--archive", help="copy raw rows to this SQLite file first")
+    p.add_argument("--chunk-size", type=int, default=50_000)
+    p.set_defaults(func=cmd_compact)
+
+    p = sub.add_parser("export", help=cmd_export.__doc__)
+    p.add_argument("--format", choices=["csv", "jsonl", "parquet"],
+                   default="csv")
+    p.add_argument("--user", help="only this user's history (default: all)")
+    p.add_argument("--start", help="inclusive, YYYY-MM-DD[ HH:MM:SS]")
+    p.add_argument("--end", help="exclusive, YYYY-MM-DD[ HH:MM:SS]")
+    p.add_argument("--material", action="append",
+                   help="only this material (repeatable)")
+    p.add_argument("-o", "--output", default="-", help="file, or - for stdout")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("reshard", help=cmd_reshard.__doc__)
+    p.add_argument("--shards", type=int, required=True,
+                   help="number of history files; 0 = keep history in --db")
+    p.set_defaults(func=cmd_reshard)
+
+    p = sub.add_parser("selfcheck", help=cmd_selfcheck.__doc__)
+    p.add_argument("--rows", type=int, default=20_000,
+                   help="synthetic history rows to seed")
+    p.set_defaults(func=cmd_selfcheck)
+
+    args = parser.parse_args(argv)
+    if args.db:
+        database.DB_PATH = args.db
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
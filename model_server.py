@@ -0,0 +1,388 @@
+"""
+model_server.py — shared YOLO inference server for EcoScanner AI.
+
+When Streamlit is scaled out to several server processes on one box,
+each of them would otherwise load its own copy of the weights and torch
+runtime. This module runs ONE model in a separate process and lets every
+app process use it as a thin client:
+
+  - Control messages (tiny tuples) go over a local Unix socket.
+  - Pixel data never goes through the socket. The client copies the
+    decoded RGB array straight into a slot of a shared-memory ring
+    buffer and the server runs the model on a zero-copy view of it.
+  - Replies are compact detection records: label, confidence, box.
+
+A supervisor owns the shared-memory segment, starts the server process,
+pings it periodically and restarts it if it dies or stops answering.
+Clients reconnect transparently after a restart.
+
+Usage:
+    python model_server.py [--socket PATH] [--slots N] [--cascade]
+                           [--band LOW,HIGH]
+
+    # then, for every app process:
+    ECOSCANNER_MODEL_SERVER=/tmp/ecoscanner-model.sock streamlit run app.py
+"""
+
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+import PIL.Image
+
+DEFAULT_SOCKET = "/tmp/ecoscanner-model.sock"
+AUTHKEY = os.environ.get("ECOSCANNER_MODEL_SERVER_KEY", "ecoscanner").encode()
+
+# Ring geometry: each slot holds one RGB frame up to MAX_SIDE x MAX_SIDE.
+# Larger uploads are downscaled client-side (YOLO resizes to 640 anyway).
+MAX_SIDE = 1920
+SLOT_BYTES = MAX_SIDE * MAX_SIDE * 3
+DEFAULT_SLOTS = 4
+
+HEALTH_INTERVAL = 5.0   # seconds between supervisor pings
+HEALTH_TIMEOUT = 10.0   # seconds to wait for a ping reply
+MAX_INFER_S = 120.0     # a single inference stuck longer than this is a hang
+
+
+def _attach(name: str, owner_tracker: bool = False) -> shared_memory.SharedMemory:
+    """
+    Attach to an existing segment without letting this process's
+    resource tracker unlink it on exit (only the supervisor owns it).
+    `owner_tracker`: this process shares the supervisor's tracker (the
+    spawned server does). Unregistering there would cancel the
+    supervisor's own registration, and a killed supervisor's ring would
+    then never be cleaned up.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # 3.13+
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        if not owner_tracker:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+def _slot_view(shm, slot: int, h: int, w: int) -> np.ndarray:
+    """HxWx3 uint8 view onto one ring slot (no copy)."""
+    return np.ndarray((h, w, 3), dtype=np.uint8, buffer=shm.buf,
+                      offset=slot * SLOT_BYTES)
+
+
+# ------------------------------------------------------------------
+# SERVER
+# ------------------------------------------------------------------
+class ModelServer:
+    """Owns the model; serves every connected client from one instance."""
+
+    def __init__(self, socket_path: str, shm_name: str, slots: int,
+                 cascade: bool = False, band: tuple = None):
+        self.socket_path = socket_path
+        self.shm = _attach(shm_name, owner_tracker=True)
+        self.slots = slots
+        self.free = queue.Queue()
+        for i in range(slots):
+            self.free.put(i)
+        self.started = time.time()
+        self.served = 0
+        self._busy_since = None
+        self._infer_lock = threading.Lock()
+
+        from logic import EcoScannerAI
+        self.scanner = EcoScannerAI(
+            cascade=cascade,
+            uncertainty_band=band or EcoScannerAI.UNCERTAINTY_BAND
+        )
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        with Listener(self.socket_path, family="AF_UNIX",
+                      authkey=AUTHKEY) as listener:
+            while True:
+                conn = listener.accept()
+                threading.Thread(
+                    target=self._handle, args=(conn,), daemon=True
+                ).start()
+
+    def _handle(self, conn):
+        held = set()
+        try:
+            while True:
+                msg = conn.recv()
+                op = msg[0]
+                if op == "hello":
+                    conn.send({"shm": self.shm.name, "slots": self.slots,
+                               "slot_bytes": SLOT_BYTES, "pid": os.getpid()})
+                elif op == "ping":
+                    conn.send(self._health())
+                elif op == "acquire":
+                    try:
+                        slot = self.free.get(timeout=msg[1])
+                        held.add(slot)
+                    except queue.Empty:
+                        slot = None
+                    conn.send(slot)
+                elif op == "infer":
+                    _, slot, h, w = msg
+                    conn.send(self._infer(slot, h, w))
+                    held.discard(slot)
+                    self.free.put(slot)
+                else:
+                    conn.send({"ok": False, "error": f"unknown op {op!r}"})
+        except (EOFError, OSError):
+            pass
+        finally:
+            # Client went away mid-request: hand its slots back to the ring
+            for slot in held:
+                self.free.put(slot)
+            conn.close()
+
+    def _infer(self, slot, h, w):
+        started = time.perf_counter()
+        try:
+            frame = _slot_view(self.shm, slot, h, w)
+            with self._infer_lock:
+                self._busy_since = time.time()
+                try:
+                    records, _ = self.scanner.detect(frame)
+                finally:
+                    self._busy_since = None
+                self.served += 1
+            return {"ok": True, "records": records,
+                    "ms": round((time.perf_counter() - started) * 1000, 2)}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+    def _health(self):
+        busy_s = time.time() - self._busy_since if self._busy_since else 0.0
+        return {"ok": busy_s < MAX_INFER_S, "busy_s": round(busy_s, 1),
+                "pid": os.getpid(), "served": self.served,
+                "free_slots": self.free.qsize(), "slots": self.slots,
+                "cascade": dict(self.scanner.cascade_stats),
+                "band": list(self.scanner.uncertainty_band),
+                "uptime_s": round(time.time() - self.started, 1)}
+
+
+def _run_server(socket_path: str, shm_name: str, slots: int, cascade: bool,
+                band: tuple):
+    # Exit with the supervisor however it died (even SIGKILL): an orphaned
+    # server would keep the model loaded and the ring attached
+    threading.Thread(target=_exit_with_parent, daemon=True).start()
+    ModelServer(socket_path, shm_name, slots, cascade, band).serve_forever()
+
+
+def _exit_with_parent():
+    mp.parent_process().join()
+    os._exit(0)
+
+
+# ------------------------------------------------------------------
+# SUPERVISOR
+# ------------------------------------------------------------------
+def supervise(socket_path: str = DEFAULT_SOCKET, slots: int = DEFAULT_SLOTS,
+              cascade: bool = False, band: tuple = None):
+    """
+    Create the shared ring, run the server in a child process and keep it
+    alive: restart on exit, or when health checks keep failing.
+    SIGTERM and SIGHUP shut down as cleanly as Ctrl-C: the child is
+    stopped, the ring unlinked and the socket file removed.
+    """
+    for sig in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(sig, _stop)
+    shm = shared_memory.SharedMemory(create=True, size=slots * SLOT_BYTES)
+    ctx = mp.get_context("spawn")
+    proc = None
+    failures = 0
+    try:
+        while True:
+            if proc is None or not proc.is_alive():
+                if proc is not None:
+                    print(f"model server exited ({proc.exitcode}); restarting")
+                proc = ctx.Process(target=_run_server,
+                                   args=(socket_path, shm.name, slots, cascade, band),
+                                   daemon=True)
+                proc.start()
+                failures = 0
+                # Model load can take a while; don't count it as unhealthy
+                _wait_for_socket(socket_path, proc)
+
+            time.sleep(HEALTH_INTERVAL)
+            try:
+                health = ping(socket_path)
+                if not health["ok"]:
+                    raise RuntimeError(f"inference stuck for {health['busy_s']} s")
+                failures = 0
+            except Exception as e:
+                failures += 1
+                print(f"model server health check failed ({failures}): {e}")
+                if failures >= 3:
+                    proc.terminate()
+                    proc.join(5)
+                    proc = None
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        # A second signal must not cut the cleanup short
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+            signal.signal(sig, signal.SIG_IGN)
+        if proc is not None:
+            proc.terminate()
+            proc.join(5)
+            if proc.is_alive():
+                proc.kill()
+        shm.close()
+        shm.unlink()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def _stop(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def _wait_for_socket(socket_path, proc, timeout=300.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline and proc.is_alive():
+        try:
+            ping(socket_path)
+            return
+        except Exception:
+            time.sleep(0.5)
+
+
+def ping(socket_path: str = DEFAULT_SOCKET) -> dict:
+    """One-shot health check; raises if the server is unreachable."""
+    conn = Client(socket_path, family="AF_UNIX", authkey=AUTHKEY)
+    try:
+        conn.send(("ping",))
+        if not conn.poll(HEALTH_TIMEOUT):
+            raise TimeoutError("no reply to ping")
+        return conn.recv()
+    finally:
+        conn.close()
+
+
+# ------------------------------------------------------------------
+# CLIENT
+# ------------------------------------------------------------------
+class ModelClient:
+    """
+    Thin client used by EcoScannerAI(server_address=...). One connection
+    per process, shared across Streamlit sessions under a lock.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET,
+                 acquire_timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.acquire_timeout = acquire_timeout
+        self._conn = None
+        self._shm = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self.close()
+        self._conn = Client(self.socket_path, family="AF_UNIX",
+                            authkey=AUTHKEY)
+        self._conn.send(("hello",))
+        info = self._conn.recv()
+        if info["slot_bytes"] != SLOT_BYTES:
+            raise RuntimeError("model server ring geometry mismatch")
+        self._shm = _attach(info["shm"])
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._shm is not None:
+            self._shm.close()
+            self._shm = None
+
+    def detect(self, img_array: np.ndarray) -> list:
+        """
+        Run the shared model on an RGB array. Returns the same records as
+        EcoScannerAI.detect(), with boxes in `img_array` coordinates.
+        """
+        h, w = img_array.shape[:2]
+        scale = min(1.0, MAX_SIDE / max(h, w))
+        if scale < 1.0:
+            small = PIL.Image.fromarray(img_array).resize(
+                (max(1, int(w * scale)), max(1, int(h * scale))),
+                PIL.Image.BILINEAR
+            )
+            img_array = np.asarray(small)
+            h, w = img_array.shape[:2]
+
+        with self._lock:
+            try:
+                reply = self._detect_once(img_array, h, w)
+            except (EOFError, ConnectionError):
+                # Server restarted under us: reconnect and retry once.
+                # Not OSError: a busy ring's TimeoutError is one, and
+                # retrying would only wait out acquire_timeout again
+                self._connect()
+                reply = self._detect_once(img_array, h, w)
+
+        if not reply.get("ok"):
+            raise RuntimeError(f"model server: {reply.get('error')}")
+        records = reply["records"]
+        if scale < 1.0:
+            for rec in records:
+                rec["box"] = [round(c / scale, 1) for c in rec["box"]]
+        return records
+
+    def _detect_once(self, img_array, h, w):
+        if self._conn is None:
+            self._connect()
+        self._conn.send(("acquire", self.acquire_timeout))
+        slot = self._conn.recv()
+        if slot is None:
+            raise TimeoutError("model server busy: no free ring slot")
+        try:
+            _slot_view(self._shm, slot, h, w)[:] = img_array
+            self._conn.send(("infer", slot, h, w))
+            return self._conn.recv()
+        except Exception:
+            # Dropping the connection makes the server reclaim the slot
+            self.close()
+            raise
+
+    def health(self) -> dict:
+        """Server health, or {"ok": False, "error": ...} if unreachable."""
+        try:
+            return ping(self.socket_path)
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EcoScanner AI model server")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET)
+    parser.add_argument("--slots", type=int, default=DEFAULT_SLOTS)
+    parser.add_argument("--cascade", action="store_true",
+                        help="nano model first, full model only when uncertain")
+    parser.add_argument("--band", type=_band,
+                        default=os.environ.get("ECOSCANNER_CASCADE_BAND"),
+                        help="cascade uncertainty band LOW,HIGH "
+                             "(default: ECOSCANNER_CASCADE_BAND or 0.25,0.6)")
+    args = parser.parse_args(argv)
+    print(f"EcoScanner model server on {args.socket} ({args.slots} slots)")
+    supervise(args.socket, args.slots, args.cascade, args.band)
+
+
+def _band(text: str) -> tuple:
+    from logic import EcoScannerAI
+    try:
+        return EcoScannerAI.parse_band(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+if __name__ == "__main__":
+    main()
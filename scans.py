@@ -0,0 +1,165 @@
+"""
+scans.py — duplicate-upload detection for EcoScanner AI.
+
+Every processed image is stored in the `scans` table with a SHA-256 of
+its bytes and a 64-bit perceptual hash (dHash). Exact re-uploads are
+found by content hash; near-duplicates (re-encoded, resized or lightly
+cropped copies of the same photo) are found through a BK-tree over the
+perceptual hashes, which answers "anything within N bits?" without
+comparing against every stored scan.
+
+A hit returns the stored detections, so the model is not run again, and
+the canonical scan id, so a detection can only be committed once.
+"""
+
+import hashlib
+import io
+import threading
+
+import numpy as np
+import PIL.Image
+
+from database import add_scan, get_oldest_scan_id, get_scan, iter_scan_hashes
+
+# Hashes that differ in at most this many of 64 bits are the same photo
+MAX_DISTANCE = 6
+
+_SIGN_BIT = 1 << 63
+
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 hex digest of the raw upload bytes."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def perceptual_hash(data: bytes) -> int:
+    """
+    64-bit difference hash of an image: 9x8 greyscale thumbnail, one bit
+    per horizontal neighbour comparison. Returned as a signed integer so
+    it fits an SQLite INTEGER column.
+    """
+    img = PIL.Image.open(io.BytesIO(data))
+    img.draft("L", (64, 64))  # JPEG: decode at reduced scale, much cheaper
+    pixels = np.asarray(
+        img.convert("L").resize((9, 8), PIL.Image.BILINEAR), dtype=np.int16
+    )
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    value = int.from_bytes(np.packbits(bits).tobytes(), "big")
+    return value - (1 << 64) if value & _SIGN_BIT else value
+
+
+def hamming(a: int, b: int) -> int:
+    """Number of differing bits between two 64-bit hashes."""
+    return bin((a ^ b) & 0xFFFFFFFFFFFFFFFF).count("1")
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes under Hamming distance.
+    Each node keeps children keyed by their distance to it; the triangle
+    inequality prunes every subtree outside [d - radius, d + radius].
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, key: int, value):
+        node = [key, [value], {}]
+        self.size += 1
+        if self.root is None:
+            self.root = node
+            return
+        cur = self.root
+        while True:
+            d = hamming(key, cur[0])
+            if d == 0:
+                cur[1].append(value)
+                return
+            child = cur[2].get(d)
+            if child is None:
+                cur[2][d] = node
+                return
+            cur = child
+
+    def search(self, key: int, radius: int):
+        """Return [(distance, value), ...] within `radius`, nearest first."""
+        found = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(key, node[0])
+            if d <= radius:
+                found.extend((d, v) for v in node[1])
+            for cd, child in node[2].items():
+                if d - radius <= cd <= d + radius:
+                    stack.append(child)
+        found.sort(key=lambda t: t[0])
+        return found
+
+
+class ScanIndex:
+    """
+    In-memory BK-tree over all stored scans, kept in sync with the
+    `scans` table. Safe to share across Streamlit sessions.
+    """
+
+    def __init__(self, max_distance: int = MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.tree = BKTree()
+        self._first_id = None
+        self._last_id = 0
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """
+        Pull scans written since the last refresh (e.g. by other workers).
+        If compact_history() has pruned scans since the tree was built
+        (oldest stored id moved past ours) the tree is rebuilt without
+        them: a BK-tree cannot delete, and stale entries would cost a
+        database round trip on every near-hit and memory forever.
+        """
+        with self._lock:
+            oldest = get_oldest_scan_id()
+            if self.tree.size and (oldest is None or oldest > self._first_id):
+                self.tree = BKTree()
+                self._first_id = None
+                self._last_id = 0
+            for scan_id, phash in iter_scan_hashes(self._last_id):
+                if self._first_id is None:
+                    self._first_id = scan_id
+                self.tree.add(phash, scan_id)
+                self._last_id = scan_id
+
+    def lookup(self, data: bytes):
+        """
+        Hash an upload and look for a stored copy of it.
+        Returns (match, content_hash, phash) where match is None or
+        (scan_id, detections, distance, stored (width, height)).
+        """
+        digest = content_hash(data)
+        exact = get_scan(content_hash=digest)
+        if exact is not None:
+            scan_id, phash, detections, size = exact
+            return (scan_id, detections, 0, size), digest, phash
+
+        phash = perceptual_hash(data)
+        self.refresh()
+        with self._lock:
+            near = self.tree.search(phash, self.max_distance)
+        for distance, scan_id in near:
+            scan = get_scan(scan_id=scan_id)
+            if scan is None:
+                continue  # pruned by compact_history() since it was indexed
+            _, _, detections, size = scan
+            return (scan_id, detections, distance, size), digest, phash
+        return None, digest, phash
+
+    def record(self, username: str, digest: str, phash: int,
+               detections: list, size=None) -> int:
+        """Persist a freshly processed scan and index it. Returns its id."""
+        width, height = size if size else (None, None)
+        scan_id = add_scan(username, digest, phash, detections, width, height)
+        self.refresh()
+        return scan_id